@@ -0,0 +1,72 @@
+"""
+Benchmark the latency and ranking stability of each search type policy
+(see :obj:`clio_lite.SEARCH_TYPES`) against a live Elasticsearch endpoint.
+
+For each query and search type, :obj:`clio_search` is repeated a number of
+times, reporting the median latency, the total number of results and the
+fraction of the top :obj:`top_k` results which are shared with the
+'dfs_query_then_fetch' ranking (i.e. the ranking with global term statistics).
+
+e.g. :obj:`python benchmarks/benchmark_search_type.py --url $URL --index $INDEX
+--fields title_of_article textBody_abstract_article --queries BERT "deep learning"`
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+# Run from anywhere, i.e. without installing clio-lite
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from clio_lite import clio_search
+from clio_lite import SEARCH_TYPES
+
+
+def benchmark(url, index, query, search_type, repeats=5, top_k=10,
+              **kwargs):
+    """Time repeated searches with the given search type.
+
+    Returns:
+        {latency, total, ids} (tuple): {median latency in ms},
+                                        {total number of results},
+                                        {ids of the top :obj:`top_k` docs}
+    """
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        total, docs = clio_search(url=url, index=index, query=query,
+                                  limit=top_k, search_type=search_type,
+                                  **kwargs)
+        latencies.append(1000*(time.perf_counter() - start))
+    return statistics.median(latencies), total, [doc['_id'] for doc in docs]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--url', required=True)
+    parser.add_argument('--index', required=True)
+    parser.add_argument('--fields', nargs='+', default=[])
+    parser.add_argument('--queries', nargs='+', required=True)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--top-k', type=int, default=10)
+    args = parser.parse_args(argv)
+
+    print('query\tsearch_type\tlatency_ms\ttotal\toverlap')
+    for query in args.queries:
+        dfs_ids = None
+        for search_type in SEARCH_TYPES:
+            latency, total, ids = benchmark(args.url, args.index, query,
+                                            search_type, repeats=args.repeats,
+                                            top_k=args.top_k,
+                                            fields=args.fields)
+            if dfs_ids is None:  # 'dfs_query_then_fetch' is first
+                dfs_ids = ids
+            overlap = (len(set(ids) & set(dfs_ids))/len(dfs_ids)
+                       if len(dfs_ids) > 0 else 1)
+            print(f'{query}\t{search_type}\t{latency:.1f}\t{total}\t{overlap:.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,26 @@
 from collections import defaultdict
+import itertools
 import json
 import logging
 import math
 import os
+import queue
 import requests
 from stop_words import get_stop_words
+import threading
 import urllib
+import weakref
 
 from clio_utils import try_pop
 from clio_utils import set_headers
 from clio_utils import make_endpoint
 from clio_utils import extract_docs
 from clio_utils import extract_keywords
+from clio_utils import extract_responses
+from clio_utils import extract_total
 from clio_utils import assert_fraction
+from clio_utils import unpack_if_safe
+from clio_utils import summarise_profile
 
 
 """
@@ -31,6 +39,67 @@ e.g. :obj:`from clio_lite import MAX_CHUNKSIZE; MAX_CHUNKSIZE = 10`
 MAX_CHUNKSIZE = 10000
 
 
+"""
+Search types: :obj:`search_type` can be any of these, where 'auto' only
+uses 'dfs_query_then_fetch' where it could affect the ranking, i.e. not for
+aggregation-only queries or single-shard indices, and not for expansions of
+seed queries with more than :obj:`AUTO_DFS_MAX_HITS` hits (for which the
+per-shard term statistics are assumed to be representative). The shard
+count is only learned from previous responses, and neither the index size
+nor any skew of documents across shards is considered.
+
+e.g. :obj:`from clio_lite import AUTO_DFS_MAX_HITS; AUTO_DFS_MAX_HITS = 1000`
+"""
+SEARCH_TYPES = ('dfs_query_then_fetch', 'query_then_fetch', 'auto')
+AUTO_DFS_MAX_HITS = 10000
+SHARD_COUNTS = {}  # Number of shards behind each endpoint, when known
+
+
+"""
+Adaptive seeding: the maximum number of seed documents to consider when
+:obj:`adaptive_seeds` is set and :obj:`n_seed_docs` isn't. Feel free to change.
+
+e.g. :obj:`from clio_lite import ADAPTIVE_SEED_CAP; ADAPTIVE_SEED_CAP = 25`
+"""
+ADAPTIVE_SEED_CAP = 10
+
+
+def resolve_search_type(search_type, endpoint, aggregation=False,
+                        hits=None):
+    """Resolve the search type policy into an ES search_type.
+
+    Args:
+        search_type (str): One of :obj:`SEARCH_TYPES`.
+        endpoint (str): URL path to _search endpoint
+        aggregation (bool): Whether the query is aggregation-only.
+        hits (int): Number of seed hits, for expanded queries.
+    Returns:
+        search_type (str): The ES search_type.
+    """
+    if search_type not in SEARCH_TYPES:
+        raise ValueError(f'search_type must be one of {SEARCH_TYPES}. '
+                         f'Invalid value of "{search_type}" was provided')
+    if search_type != 'auto':
+        return search_type
+    # Term statistics don't affect aggregations, and
+    # are already global for single-shard indices
+    if aggregation or SHARD_COUNTS.get(endpoint) == 1:
+        return 'query_then_fetch'
+    if hits is not None and hits > AUTO_DFS_MAX_HITS:
+        return 'query_then_fetch'
+    return 'dfs_query_then_fetch'
+
+
+def record_shards(endpoint, r):
+    """Remember the number of shards behind the endpoint, for 'auto',
+    from the :obj:`requests.Response` or the raw ES data"""
+    try:
+        data = r if type(r) is dict else json.loads(r.text)
+        SHARD_COUNTS[endpoint] = data['_shards']['total']
+    except (ValueError, KeyError, TypeError):
+        pass
+
+
 def combined_score(keyword_scores):
     """Combine Lucene keyword scores according to my own recipe,
     which is calculate a weighted combination of the scores,
@@ -46,10 +115,42 @@ def combined_score(keyword_scores):
     return math.sqrt(numerator/denominator)
 
 
+def select_seeds(docs, min_score_frac=0.5):
+    """Cut the seed documents (ranked by score) at whichever comes first
+    of: the knee of the score curve (i.e. the first document after the
+    drop); or the first document scoring less than :obj:`min_score_frac`
+    of the top score. Weak seeds dilute the
+    MLT centroid, and make the expanded query more expensive.
+
+    Args:
+        docs (list): Ranked seed documents, including their '_score'.
+        min_score_frac (float): Minimum score, relative to the top score.
+    Returns:
+        seeds (list): The selected documents (without their '_score').
+    """
+    if len(docs) == 0:
+        return []
+    scores = [doc['_score'] for doc in docs]
+    top, bottom = scores[0], scores[-1]
+    n_seeds = sum(score >= min_score_frac*top for score in scores)
+    # The knee is the point furthest below the line joining the highest
+    # and lowest (normalised) scores, if it is clearly below the line,
+    # and is the first of the weak seeds
+    if len(scores) > 2 and top > bottom:
+        distances = [(1 - i/(len(scores) - 1)) - (score - bottom)/(top - bottom)
+                     for i, score in enumerate(scores)]
+        knee = max(range(len(distances)), key=lambda i: distances[i])
+        if distances[knee] > 0.1:
+            n_seeds = min(n_seeds, knee)
+    return [dict(_id=doc['_id'], _index=doc['_index'])
+            for doc in docs[:max(n_seeds, 1)]]
+
+
 def simple_query(endpoint, query, fields, filters,
                  size=None, aggregations=None,
-                 response_mode=False,
-                 **kwargs):
+                 response_mode=False, session=None,
+                 profile=False, search_type='dfs_query_then_fetch',
+                 include_score=False, **kwargs):
     """Perform a simple query on Elasticsearch.
 
     Args:
@@ -60,6 +161,12 @@ def simple_query(endpoint, query, fields, filters,
         size (int): Number of documents to return.
         aggregations: Do not use this directly. See :obj:`clio_keywords`.
         response_mode: Do not use this directly. See :obj:`clio_lite_searchkit_lambda`.
+        session (requests.Session): Session (i.e. connection pool) with which
+                                    to make the request, if not :obj:`requests`.
+        profile (bool): Profile the query, and also return a summary of the
+                        profile (see :obj:`summarise_profile`).
+        search_type (str): One of :obj:`SEARCH_TYPES`.
+        include_score (bool): Include the '_score' of each doc.
     Returns:
         {total, docs} (tuple): {total number of docs}, {top :obj:`size` docs}
     """
@@ -82,22 +189,135 @@ def simple_query(endpoint, query, fields, filters,
         _query.pop('_source')
     elif size is not None:
         _query['size'] = size
+    if profile:
+        _query['profile'] = True
     # Make the query
     logging.debug(_query)
-    r = requests.post(url=endpoint, data=json.dumps(_query),
-                      params={"search_type": "dfs_query_then_fetch"},
-                      **kwargs)
+    _search_type = resolve_search_type(search_type, endpoint,
+                                       aggregation=aggregations is not None)
+    r = (session or requests).post(url=endpoint, data=json.dumps(_query),
+                                   params={"search_type": _search_type},
+                                   **kwargs)
+    if search_type == 'auto':
+        record_shards(endpoint, r)
     # "Aggregation mode"
     if aggregations is not None:
+        if profile:
+            return extract_keywords(r), summarise_profile(unpack_if_safe(r))
         return extract_keywords(r)
 
-    total, docs = extract_docs(r)
+    total, docs = extract_docs(r, include_score=include_score)
     # "Response mode"
     if response_mode and total == 0:
-        return total, r
+        docs = r
+    if profile:
+        return total, docs, summarise_profile(unpack_if_safe(r))
     return total, docs
 
 
+def make_mlt_query(docs, fields, min_term_freq, max_query_terms,
+                   min_doc_frac, max_doc_frac, min_should_match,
+                   total, stop_words=STOP_WORDS, filters=[]):
+    """Formulate the body of an MLT query, without making the request.
+    See :obj:`more_like_this` for a description of the arguments.
+
+    Returns:
+        _query (dict): The MLT query body.
+    """
+    # Check that the fractions are fractions, to avoid weird behaviour
+    assert_fraction(min_should_match)
+    assert_fraction(min_doc_frac)
+    assert_fraction(max_doc_frac)
+
+    # Formulate the MLT query
+    msm = int(min_should_match*100)
+    max_doc_freq = int(max_doc_frac*total)
+    min_doc_freq = int(min_doc_frac*total)
+    mlt = {
+        "more_like_this": {
+            "fields": fields if fields != [] else None,
+            "like": docs,
+            "min_term_freq": min_term_freq,
+            "max_query_terms": max_query_terms,
+            "min_doc_freq": min_doc_freq,
+            "max_doc_freq": max_doc_freq,
+            "boost_terms": 1,
+            "stop_words": stop_words,
+            "minimum_should_match": f'{msm}%',
+            "include": True,
+        }
+    }
+    return {"query": {"bool": {"filter": filters, "must": [mlt]}}}
+
+
+def make_mlt_search(endpoint, docs, fields, limit, offset,
+                    min_term_freq, max_query_terms,
+                    min_doc_frac, max_doc_frac,
+                    min_should_match, total,
+                    stop_words=STOP_WORDS, filters=[], scroll=None,
+                    profile=False, search_type='dfs_query_then_fetch'):
+    """Formulate the body and URL parameters of an MLT search, without
+    making the request. See :obj:`more_like_this` for a description of
+    the arguments.
+
+    Returns:
+        {_query, params} (tuple): {The MLT query body}, {URL parameters}.
+    """
+    _query = make_mlt_query(docs=docs, fields=fields,
+                            min_term_freq=min_term_freq,
+                            max_query_terms=max_query_terms,
+                            min_doc_frac=min_doc_frac,
+                            max_doc_frac=max_doc_frac,
+                            min_should_match=min_should_match,
+                            total=total, stop_words=stop_words,
+                            filters=filters)
+    params = {"search_type": resolve_search_type(search_type, endpoint,
+                                                 hits=total)}
+    # Offset assumes no scrolling (since it would be invalid)
+    if offset is not None and offset < total:
+        _query['from'] = offset
+    # If scrolling was specified
+    elif scroll is not None:
+        params['scroll'] = scroll
+    # The number of docs returned
+    if limit is not None:
+        _query['size'] = limit
+    if profile:
+        _query['profile'] = True
+    return _query, params
+
+
+def msearch(endpoint, bodies, params={}, session=None,
+            search_types=None, **kwargs):
+    """Make several queries in a single _msearch request, which
+    Elasticsearch will execute concurrently.
+
+    Args:
+        endpoint (str): URL path to _msearch endpoint
+        bodies (list): The query bodies to make.
+        params (dict): URL parameters (e.g. search_type) for the request.
+        session (requests.Session): Session (i.e. connection pool) with which
+                                    to make the request, if not :obj:`requests`.
+        search_types (list): ES search_type for each query, if they differ.
+    Returns:
+        responses (list): The raw ES data for each query, in order.
+    """
+    lines = []
+    for i, body in enumerate(bodies):
+        header = {}
+        if search_types is not None:
+            header['search_type'] = search_types[i]
+        lines.append(json.dumps(header))
+        lines.append(json.dumps(body))
+    headers = dict(kwargs.pop('headers', {}))
+    headers['Content-Type'] = 'application/x-ndjson'
+    logging.debug(lines)
+    r = (session or requests).post(url=endpoint,
+                                   data='\n'.join(lines) + '\n',
+                                   params=params, headers=headers, **kwargs)
+    return extract_responses(r)
+
+
 def more_like_this(endpoint, docs, fields, limit, offset,
                    min_term_freq, max_query_terms,
                    min_doc_frac, max_doc_frac,
@@ -106,6 +326,8 @@ def more_like_this(endpoint, docs, fields, limit, offset,
                    filters=[], scroll=None,
                    response_mode=False,
                    post_aggregation={},
+                   session=None, profile=False,
+                   search_type='dfs_query_then_fetch',
                    **kwargs):
     """Make an MLT query
 
@@ -130,61 +352,52 @@ def more_like_this(endpoint, docs, fields, limit, offset,
                            to standard English stop words.
         filters (list): ES filters to supply to the query.
         scroll (str): ES scroll time window (e.g. '1m').
+        session (requests.Session): Session (i.e. connection pool) with which
+                                    to make the request, if not :obj:`requests`.
+        profile (bool): Profile the query, and also return a summary of the
+                        profile (see :obj:`summarise_profile`).
+        search_type (str): One of :obj:`SEARCH_TYPES`.
     Returns:
         {total, docs} (tuple): {total number of docs}, {top :obj:`size` docs}.
     """
     # If there are no documents to expand from
     if total == 0:
-        return (0, [])
-    # Check that the fractions are fractions, to avoid weird behaviour
-    assert_fraction(min_should_match)
-    assert_fraction(min_doc_frac)
-    assert_fraction(max_doc_frac)
-
-    # Formulate the MLT query
-    msm = int(min_should_match*100)
-    max_doc_freq = int(max_doc_frac*total)
-    min_doc_freq = int(min_doc_frac*total)
-    mlt = {
-        "more_like_this": {
-            "fields": fields if fields != [] else None,
-            "like": docs,
-            "min_term_freq": min_term_freq,
-            "max_query_terms": max_query_terms,
-            "min_doc_freq": min_doc_freq,
-            "max_doc_freq": max_doc_freq,
-            "boost_terms": 1,
-            "stop_words": stop_words,
-            "minimum_should_match": f'{msm}%',
-            "include": True,
-        }
-    }
-    _query = {"query": {"bool": {"filter": filters, "must": [mlt]}}}
-    params = {"search_type": "dfs_query_then_fetch"}
-    # Offset assumes no scrolling (since it would be invalid)
-    if offset is not None and offset < total:
-        _query['from'] = offset
-    # If scrolling was specified
-    elif scroll is not None:
-        params['scroll'] = scroll
-    # The number of docs returned
-    if limit is not None:
-        _query['size'] = limit
+        return (0, [], None) if profile else (0, [])
+    _query, params = make_mlt_search(endpoint=endpoint, docs=docs,
+                                     fields=fields, limit=limit,
+                                     offset=offset,
+                                     min_term_freq=min_term_freq,
+                                     max_query_terms=max_query_terms,
+                                     min_doc_frac=min_doc_frac,
+                                     max_doc_frac=max_doc_frac,
+                                     min_should_match=min_should_match,
+                                     total=total, stop_words=stop_words,
+                                     filters=filters, scroll=scroll,
+                                     profile=profile,
+                                     search_type=search_type)
     # Make the query
     logging.debug(_query)
-    r = requests.post(url=endpoint,
-                      data=json.dumps(dict(**post_aggregation, **_query)),
-                      params=params,
-                      **kwargs)
+    r = (session or requests).post(url=endpoint,
+                                   data=json.dumps(dict(**post_aggregation,
+                                                        **_query)),
+                                   params=params,
+                                   **kwargs)
+    if search_type == 'auto':
+        record_shards(endpoint, r)
     if response_mode:
-        return None, r
+        total, docs = None, r
     # If successful, return
-    return extract_docs(r, scroll=scroll, include_score=True)
+    else:
+        total, docs = extract_docs(r, scroll=scroll, include_score=True)
+    if profile:
+        return total, docs, summarise_profile(unpack_if_safe(r))
+    return total, docs
 
 
 def clio_keywords(url, index, fields, max_query_terms=10,
                   filters=[], stop_words=STOP_WORDS,
-                  shard_size=5000,
+                  shard_size=5000, profile=False,
+                  search_type='dfs_query_then_fetch',
                   **kwargs):
     """Discover keywords associated with a seed query.
 
@@ -197,8 +410,14 @@ def clio_keywords(url, index, fields, max_query_terms=10,
         stop_words (list): A supplementary list of terms to ignore. Defaults
                            to standard English stop words.
         shard_size (int): ES shard_size (increases sample doc size).
+        profile (bool): Profile the query for each field, and also return
+                        a summary of each profile
+                        (see :obj:`summarise_profile`).
+        search_type (str): One of :obj:`SEARCH_TYPES`.
     Returns:
         keywords (list): A list of keywords and their scores.
+        profiles (dict): If :obj:`profile`, a summary of the profile of the
+                         query for each field.
     """
     set_headers(kwargs)
     endpoint = make_endpoint(url, index)
@@ -220,12 +439,17 @@ def clio_keywords(url, index, fields, max_query_terms=10,
     # The aggregation can only be performed once per field,
     # so terms can be given multiple scores across fields.
     data = defaultdict(list)  # Mapping of term to scores for that term
+    profiles = {}
     for field in fields:
         # Set the field and make the query
         (keyword_agg['_keywords']['aggregations']['keywords']
                     ['significant_text']['field']) = field
         kws = simple_query(endpoint=endpoint, fields=[field],
-                           filters=filters, aggregations=keyword_agg, **kwargs)
+                           filters=filters, aggregations=keyword_agg,
+                           profile=profile, search_type=search_type,
+                           **kwargs)
+        if profile:
+            kws, profiles[field] = kws
         # Append keywords if not stop words
         for kw in kws:
             word = kw.pop('key')
@@ -237,9 +461,38 @@ def clio_keywords(url, index, fields, max_query_terms=10,
     keywords = sorted((dict(key=word, score=combined_score(info))
                        for word, info in data.items()),
                       key=lambda kw: kw['score'], reverse=True)
+    if profile:
+        return keywords, profiles
     return keywords
 
 
+def seed_query(endpoint, query, fields, filters, n_seed_docs=None,
+               adaptive_seeds=False, min_seed_score_frac=0.5, **kwargs):
+    """Make the seed query of a contextual search, only keeping the
+    strongest seed documents if :obj:`adaptive_seeds`. See
+    :obj:`clio_search` for a description of the arguments, and
+    :obj:`simple_query` for any others.
+
+    Returns:
+        {total, docs} (tuple): As for :obj:`simple_query`.
+    """
+    if adaptive_seeds and n_seed_docs is None:
+        n_seed_docs = ADAPTIVE_SEED_CAP
+    total, docs, *seed_profile = simple_query(endpoint=endpoint,
+                                              query=query,
+                                              fields=fields,
+                                              size=n_seed_docs,
+                                              filters=filters,
+                                              include_score=adaptive_seeds,
+                                              **kwargs)
+    # Only expand from the strongest seeds
+    if adaptive_seeds and total != 0:
+        n_returned = len(docs)
+        docs = select_seeds(docs, min_score_frac=min_seed_score_frac)
+        logging.info(f'Using {len(docs)} of {n_returned} seed docs')
+    return (total, docs, *seed_profile)
+
+
 def clio_search(url, index, query,
                 fields=[], n_seed_docs=None,
                 limit=None, offset=None,
@@ -247,7 +500,10 @@ def clio_search(url, index, query,
                 min_doc_frac=0.001, max_doc_frac=0.9,
                 min_should_match=0.1, pre_filters=[],
                 post_filters=[], stop_words=STOP_WORDS,
-                scroll=None, post_aggregation={}, **kwargs):
+                scroll=None, post_aggregation={}, profile=False,
+                search_type='dfs_query_then_fetch',
+                adaptive_seeds=False, min_seed_score_frac=0.5,
+                **kwargs):
     """Perform a contextual search of Elasticsearch data.
 
     Args:
@@ -274,42 +530,297 @@ def clio_search(url, index, query,
         stop_words (list): A supplementary list of terms to ignore. Defaults
                            to standard English stop words.
         scroll (str): ES scroll time window (e.g. '1m').
+        profile (bool): Profile the seed and expanded queries, and also
+                        return a summary of each profile
+                        (see :obj:`summarise_profile`).
+        search_type (str): One of :obj:`SEARCH_TYPES`.
+        adaptive_seeds (bool): Only expand from the strongest seed
+                               documents (up to :obj:`n_seed_docs`, or
+                               :obj:`ADAPTIVE_SEED_CAP`), see
+                               :obj:`select_seeds`.
+        min_seed_score_frac (float): If :obj:`adaptive_seeds`, the minimum
+                                     seed score relative to the top score.
     Returns:
         {total, docs} (tuple): {total number of docs}, {top :obj:`size` docs}.
+        profiles (dict): If :obj:`profile` or :obj:`adaptive_seeds`, the
+                         number of seed docs used ('n_seed_docs'), and
+                         (if :obj:`profile`) a summary of the profile of
+                         the 'seed' and 'expansion' queries.
     """
     set_headers(kwargs)
     endpoint = make_endpoint(url, index)
+    profiles = {'seed': None, 'expansion': None, 'n_seed_docs': 0}
+    with_profiles = profile or adaptive_seeds
     # Make the seed query
-    total, docs = simple_query(endpoint=endpoint,
-                               query=query,
-                               fields=fields,
-                               size=n_seed_docs,
-                               filters=pre_filters,
-                               **kwargs)
+    total, docs, *seed_profile = seed_query(
+        endpoint=endpoint, query=query, fields=fields,
+        n_seed_docs=n_seed_docs, filters=pre_filters,
+        adaptive_seeds=adaptive_seeds,
+        min_seed_score_frac=min_seed_score_frac,
+        profile=profile, search_type=search_type, **kwargs)
+    if profile:
+        profiles['seed'] = seed_profile[0]
 
     # May as well break out early if there aren't any hits
     if total == 0:
-        return total, docs
+        return (total, docs, profiles) if with_profiles else (total, docs)
+    profiles['n_seed_docs'] = len(docs)
 
     # Make the expanded search query
-    total, docs = more_like_this(endpoint=endpoint,
-                                 docs=docs, fields=fields,
-                                 limit=limit, offset=offset,
-                                 min_term_freq=min_term_freq,
-                                 max_query_terms=max_query_terms,
-                                 min_doc_frac=min_doc_frac,
-                                 max_doc_frac=max_doc_frac,
-                                 min_should_match=min_should_match,
-                                 total=total,
-                                 stop_words=stop_words,
-                                 filters=post_filters,
-                                 post_aggregation=post_aggregation,
-                                 scroll=scroll,
-                                 **kwargs)
-    return total, docs
+    total, docs, *mlt_profile = more_like_this(
+        endpoint=endpoint, docs=docs, fields=fields,
+        limit=limit, offset=offset,
+        min_term_freq=min_term_freq,
+        max_query_terms=max_query_terms,
+        min_doc_frac=min_doc_frac,
+        max_doc_frac=max_doc_frac,
+        min_should_match=min_should_match,
+        total=total,
+        stop_words=stop_words,
+        filters=post_filters,
+        post_aggregation=post_aggregation,
+        scroll=scroll,
+        profile=profile,
+        search_type=search_type,
+        **kwargs)
+    if profile:
+        profiles['expansion'] = mlt_profile[0]
+    return (total, docs, profiles) if with_profiles else (total, docs)
+
+
+def clio_sweep(url, index, query, param_grid,
+               fields=[], n_seed_docs=None, pre_filters=[],
+               post_filters=[], stop_words=STOP_WORDS,
+               top_k=10, count_only=False,
+               max_concurrent_searches=None,
+               search_type='dfs_query_then_fetch', **kwargs):
+    """Sweep the expansion hyperparameters of a contextual search. The seed
+    query is made only once, and the expanded queries for every parameter
+    set are then made concurrently via a single _msearch request.
+
+    Args:
+        url (str): URL path to bare ES endpoint.
+        index (str): Index to query.
+        query (str): The simple text query to Elasticsearch.
+        param_grid (dict or list): Either a mapping of hyperparameter
+                                   (min_term_freq, max_query_terms,
+                                   min_doc_frac, max_doc_frac,
+                                   min_should_match) to a list of values
+                                   to sweep over, or an explicit list of
+                                   parameter sets. Hyperparameters which
+                                   aren't specified take the
+                                   :obj:`clio_search` defaults.
+        fields (list): List of fields to query.
+        n_seed_docs (int): Use a maxmimum of this many seed documents.
+        {pre,post}_filters (list): ES filters to supply to the
+                                   {seed,expanded} queries.
+        stop_words (list): A supplementary list of terms to ignore. Defaults
+                           to standard English stop words.
+        top_k (int): Number of top ranked docs to compare across parameter
+                     sets.
+        count_only (bool): Only retrieve the totals (no docs).
+        max_concurrent_searches (int): Limit on the number of expanded
+                                       queries that ES executes at once.
+        search_type (str): One of :obj:`SEARCH_TYPES`.
+    Returns:
+        table (list): One row per parameter set, with the parameters,
+                      the total number of docs, the fraction of the
+                      top :obj:`top_k` docs shared with the first
+                      parameter set ("overlap", None if
+                      :obj:`count_only`) and the ES latency in ms ("took").
+    """
+    set_headers(kwargs)
+    # Expand the grid into explicit parameter sets
+    if type(param_grid) is dict:
+        keys = list(param_grid)
+        param_sets = [dict(zip(keys, values)) for values in
+                      itertools.product(*(param_grid[k] for k in keys))]
+    else:
+        param_sets = list(param_grid)
+    defaults = dict(min_term_freq=1, max_query_terms=10,
+                    min_doc_frac=0.001, max_doc_frac=0.9,
+                    min_should_match=0.1)
+
+    # Make the seed query, once only
+    endpoint = make_endpoint(url, index)
+    seed_total, docs = simple_query(endpoint=endpoint, query=query,
+                                    fields=fields, size=n_seed_docs,
+                                    filters=pre_filters,
+                                    search_type=search_type, **kwargs)
+    if seed_total == 0:
+        return [dict(**dict(defaults, **params), total=0,
+                     overlap=None, took=0) for params in param_sets]
+
+    # Formulate every expanded query
+    bodies = []
+    for params in param_sets:
+        _query = make_mlt_query(docs=docs, fields=fields,
+                                total=seed_total, stop_words=stop_words,
+                                filters=post_filters,
+                                **dict(defaults, **params))
+        if count_only:
+            _query['size'] = 0
+            _query['track_total_hits'] = True
+        else:
+            _query['size'] = top_k
+            _query['_source'] = False
+        bodies.append(_query)
+
+    # Fan out the expanded queries in a single request
+    params = {"search_type": resolve_search_type(search_type, endpoint,
+                                                 hits=seed_total)}
+    if max_concurrent_searches is not None:
+        params['max_concurrent_searches'] = max_concurrent_searches
+    responses = msearch(make_endpoint(url, index, api='_msearch'),
+                        bodies=bodies, params=params, **kwargs)
+
+    # Tabulate the results
+    table, first_ids = [], None
+    for params, data in zip(param_sets, responses):
+        overlap = None
+        if not count_only:
+            ids = [row['_id'] for row in data['hits']['hits']]
+            if first_ids is None:
+                first_ids = ids
+            overlap = (len(set(ids) & set(first_ids)) / len(first_ids)
+                       if len(first_ids) > 0 else None)
+        table.append(dict(**dict(defaults, **params),
+                          total=extract_total(data),
+                          overlap=overlap, took=data['took']))
+    return table
+
+
+def _put_until_stopped(pages, item, stop):
+    """Put an item on the queue, unless the consumer has stopped
+    listening (in which case the item is dropped)."""
+    while not stop.is_set():
+        try:
+            pages.put(item, timeout=0.1)
+        except queue.Full:
+            continue
+        return
+
+
+def _delete_scroll(endpoint, scroll_id, headers):
+    """Release the scroll context on the cluster"""
+    try:
+        requests.delete(endpoint,
+                        data=json.dumps({'scroll_id': [scroll_id]}),
+                        headers=headers)
+    except Exception as err:
+        logging.warning(f'Failed to clear scroll context: {err}')
+
+
+def _fetch_pages(endpoint, state, lock, chunksize, scroll, headers,
+                 pages, stop):
+    """Background worker for :obj:`ScrollManager`: keep fetching scroll
+    pages onto the queue until they are exhausted, or until stopped."""
+    try:
+        docs = []
+        while not stop.is_set():
+            with lock:
+                sent_id = state.get('scroll_id')
+            r = requests.post(endpoint,
+                              data=json.dumps({'scroll': scroll,
+                                               'scroll_id': sent_id}),
+                              headers=headers)
+            scroll_id, docs = extract_docs(r, scroll=scroll)
+            # The scroll id can change from page to page, so if the scroll
+            # has been cleared in the meantime, this one needs clearing too
+            with lock:
+                stopped = stop.is_set()
+                if not stopped and type(scroll_id) is str:
+                    state['scroll_id'] = scroll_id
+            if stopped:
+                if type(scroll_id) is str and scroll_id != sent_id:
+                    _delete_scroll(endpoint, scroll_id, headers)
+                break
+            _put_until_stopped(pages, docs, stop)
+            if len(docs) < chunksize:
+                break
+    except Exception as err:
+        _put_until_stopped(pages, err, stop)
+    _put_until_stopped(pages, None, stop)  # Sentinel for "no more pages"
+
+
+def _clear_scroll(endpoint, state, lock, stop, headers):
+    """Stop fetching pages, and release the scroll context on the
+    cluster, rather than leaving it open until it times out."""
+    with lock:
+        stop.set()
+        scroll_id = try_pop(state, 'scroll_id')
+    if type(scroll_id) is str:
+        _delete_scroll(endpoint, scroll_id, headers)
+
+
+class ScrollManager:
+    """Iterate over the pages of an ES scroll, prefetching the next
+    page(s) in the background whilst the current page is being consumed.
+    The scroll context is cleared when the iteration completes, or when
+    the manager is closed, exits as a context manager or is
+    garbage collected.
+
+    Args:
+        url (str): URL path to bare ES endpoint.
+        scroll_id (str): The scroll id from the first search.
+        docs (list): The first page of docs, from the first search.
+        chunksize (int): Page size of the scroll.
+        scroll (str): ES scroll time window (e.g. '1m').
+        prefetch (int): Maximum number of pages to fetch ahead.
+        headers (dict): Any headers to send with the scroll requests.
+    """
+    def __init__(self, url, scroll_id, docs, chunksize,
+                 scroll='1m', prefetch=2, headers=None):
+        self.docs = docs
+        self.pages = queue.Queue(maxsize=max(prefetch, 1))
+        endpoint = urllib.parse.urljoin(f'{url}/', '_search/scroll')
+        headers = dict(headers or {}, **{'Content-Type': 'application/json'})
+        # Shared state, kept separate from self so that
+        # the manager can be garbage collected
+        state = {'scroll_id': scroll_id}
+        lock = threading.Lock()
+        stop = threading.Event()
+        self._finalizer = weakref.finalize(self, _clear_scroll, endpoint,
+                                           state, lock, stop, headers)
+        # Only start fetching if there is anything left to fetch
+        self.thread = None
+        if len(docs) == chunksize:
+            self.thread = threading.Thread(target=_fetch_pages,
+                                           args=(endpoint, state, lock,
+                                                 chunksize, scroll, headers,
+                                                 self.pages, stop),
+                                           daemon=True)
+            self.thread.start()
+
+    def __iter__(self):
+        # Nothing more will be fetched once closed
+        if not self._finalizer.alive:
+            return
+        try:
+            yield self.docs
+            while self.thread is not None and self._finalizer.alive:
+                docs = self.pages.get()
+                if docs is None:
+                    break
+                if isinstance(docs, Exception):
+                    raise docs
+                yield docs
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop prefetching and clear the scroll context"""
+        self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
 
-def clio_search_iter(url, index, chunksize=1000, scroll='1m', **kwargs):
+def clio_search_iter(url, index, chunksize=1000, scroll='1m',
+                     prefetch=2, **kwargs):
     """Perform a *bulk* (streamed) contextual search of Elasticsearch data.
 
     Args:
@@ -334,6 +845,9 @@ def clio_search_iter(url, index, chunksize=1000, scroll='1m', **kwargs):
         stop_words (list): A supplementary list of terms to ignore. Defaults
                            to standard English stop words.
         scroll (str): ES scroll time window (e.g. '1m').
+        prefetch (int): Maximum number of chunks to fetch ahead in the
+                        background.
+        search_type (str): One of :obj:`SEARCH_TYPES`.
     Yields:
         Single rows of data
     """
@@ -342,18 +856,16 @@ def clio_search_iter(url, index, chunksize=1000, scroll='1m', **kwargs):
     if chunksize > MAX_CHUNKSIZE:
         logging.warning(f'Will not consider chunksize greater than {MAX_CHUNKSIZE}. '
                         f'Reverting to chunksize={MAX_CHUNKSIZE}.')
+        chunksize = MAX_CHUNKSIZE
     # First search
-    scroll_id, docs = clio_search(url=url, index=index,
-                                  limit=chunksize, scroll=scroll, **kwargs)
-    for row in docs:
-        yield row
+    scroll_id, docs, *_ = clio_search(url=url, index=index,
+                                      limit=chunksize, scroll=scroll,
+                                      **kwargs)
     # Keep scrolling if required
-    endpoint = urllib.parse.urljoin(f'{url}/', '_search/scroll')
-    while len(docs) == chunksize:
-        r = requests.post(endpoint,
-                          data=json.dumps({'scroll': scroll,
-                                           'scroll_id': scroll_id}),
-                          headers={'Content-Type': 'application/json'})
-        _, docs = extract_docs(r)
-        for row in docs:
-            yield row
+    with ScrollManager(url=url, scroll_id=scroll_id, docs=docs,
+                       chunksize=chunksize, scroll=scroll,
+                       prefetch=prefetch,
+                       headers=kwargs.get('headers')) as pages:
+        for docs in pages:
+            for row in docs:
+                yield row
@@ -0,0 +1,266 @@
+"""
+Command-line interface for bulk runs of :obj:`clio_search`,
+:obj:`clio_keywords` and :obj:`clio_search_iter`.
+
+Queries are read as JSONL (from a file or stdin), where each line is an
+object containing the :obj:`query` and any other keyword arguments for
+the chosen mode, and optionally an :obj:`id` for labelling the output
+(the line number is used otherwise). For example:
+
+    {"id": "bert", "query": "BERT", "limit": 10, "min_should_match": 0.3}
+
+Results are streamed as JSONL to stdout (or one file per query with
+:obj:`--output-dir`) as soon as they finish, and progress is reported
+to stderr.
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+from clio_utils import try_pop
+from clio_utils import TokenBucket
+from clio_lite import clio_search
+from clio_lite import clio_keywords
+from clio_lite import clio_search_iter
+
+
+def safe_filename(_id):
+    """Make the query id safe to use as a file name in the output
+    directory, i.e. no path separators or relative paths"""
+    return re.sub(r'[^\w-]', '_', str(_id))
+
+
+class Writer:
+    """Thread-safe writer of JSONL records, either to a stream
+    or to one file per query id in :obj:`output_dir`. Ids which
+    map to the same file name are de-duplicated with a numeric
+    suffix, and each file is kept open until :obj:`close`d."""
+    def __init__(self, stream=None, output_dir=None):
+        self.stream = stream or sys.stdout
+        self.output_dir = output_dir
+        self.paths = {}  # The file for each query id
+        self.files = {}  # Open files, by query id
+        self.lock = threading.Lock()
+
+    def _open(self, _id):
+        with self.lock:
+            if _id in self.files:
+                return self.files[_id]
+            # Reopening a query id appends to its file
+            mode = 'a' if _id in self.paths else 'w'
+            if _id not in self.paths:
+                name, n = safe_filename(_id), 0
+                path = os.path.join(self.output_dir, f'{name}.jsonl')
+                used = set(self.paths.values())
+                while path in used:
+                    n += 1
+                    path = os.path.join(self.output_dir, f'{name}-{n}.jsonl')
+                self.paths[_id] = path
+            self.files[_id] = open(self.paths[_id], mode)
+            return self.files[_id]
+
+    def write(self, _id, record):
+        line = json.dumps(dict(id=_id, **record)) + '\n'
+        if self.output_dir is None:
+            with self.lock:
+                self.stream.write(line)
+                self.stream.flush()
+            return
+        # Each query is only handled by a single worker, so only
+        # opening the file needs the lock
+        self._open(_id).write(line)
+
+    def close(self, _id):
+        """Close the file for the query id, once the query is finished"""
+        with self.lock:
+            f = self.files.pop(_id, None)
+        if f is not None:
+            f.close()
+
+
+class Progress:
+    """Thread-safe counter, which reports progress and
+    throughput to stderr at most every :obj:`interval` seconds."""
+    def __init__(self, stream=None, interval=1):
+        self.stream = stream or sys.stderr
+        self.interval = interval
+        self.done, self.failed, self.rows = 0, 0, 0
+        self.start = self.last_report = time.monotonic()
+        self.lock = threading.Lock()
+
+    def update(self, rows=0, failed=False):
+        with self.lock:
+            self.done += 1
+            self.failed += int(failed)
+            self.rows += rows
+            now = time.monotonic()
+            if now - self.last_report >= self.interval:
+                self.last_report = now
+                self.report(now)
+
+    def warn(self, message):
+        with self.lock:
+            self.stream.write(f'{message}\n')
+            self.stream.flush()
+
+    def report(self, now=None):
+        elapsed = (now or time.monotonic()) - self.start
+        rate = self.done/elapsed if elapsed > 0 else 0
+        self.stream.write(f'{self.done} queries ({self.failed} failed), '
+                          f'{self.rows} results, {rate:.2f} queries/s, '
+                          f'{elapsed:.1f}s elapsed\n')
+        self.stream.flush()
+
+
+def run_query(mode, _id, kwargs, writer, limiter=None):
+    """Run a single query, writing the results as they arrive.
+
+    Returns:
+        rows (int): The number of results written.
+    """
+    if limiter is not None:
+        limiter.acquire()
+    if mode == 'search':
+        total, docs, *profiles = clio_search(**kwargs)
+        record = dict(total=total, docs=docs)
+        if profiles:  # i.e. if profiling or using adaptive seeds
+            record['profiles'] = profiles[0]
+        writer.write(_id, record)
+        return len(docs)
+    elif mode == 'keywords':
+        if kwargs.get('profile'):
+            keywords, profiles = clio_keywords(**kwargs)
+            record = dict(keywords=keywords, profiles=profiles)
+        else:
+            keywords = clio_keywords(**kwargs)
+            record = dict(keywords=keywords)
+        writer.write(_id, record)
+        return len(keywords)
+    # Otherwise, stream the rows from the iterator
+    rows = 0
+    for row in clio_search_iter(**kwargs):
+        writer.write(_id, dict(doc=row))
+        rows += 1
+    return rows
+
+
+def read_queries(lines, defaults):
+    """Generate (id, kwargs) from JSONL input, where
+    :obj:`defaults` are overridden by each row. Rows which
+    can't be read are generated as (line number, exception)."""
+    for i, line in enumerate(lines):
+        if line.strip() == '':
+            continue
+        try:
+            row = json.loads(line)
+            if type(row) is not dict:
+                raise ValueError(f'Expected a JSON object, got {line!r}')
+        except ValueError as err:
+            yield i, err
+            continue
+        _id = try_pop(row, 'id', i)
+        yield _id, dict(defaults, **row)
+
+
+def run_batch(mode, queries, writer, progress,
+              workers=4, rate=None):
+    """Run the queries through a bounded pool of workers.
+
+    Args:
+        mode (str): One of 'search', 'keywords' or 'iter'.
+        queries (iterable): (id, kwargs) for each query, where kwargs
+                            can be an exception (for unreadable queries).
+        writer (Writer): Destination for results.
+        progress (Progress): Progress counter.
+        workers (int): Number of concurrent workers.
+        rate (float): Maximum number of queries to start per second.
+    """
+    limiter = None if rate is None else TokenBucket(rate)
+    # Don't read further ahead than the workers can keep up with
+    slots = threading.BoundedSemaphore(2*workers)
+
+    def fail(_id, err):
+        try:
+            writer.write(_id, dict(error=repr(err)))
+        except Exception as write_err:
+            progress.warn(f'Query {_id} failed with {err!r}, and the error '
+                          f'could not be written: {write_err!r}')
+
+    def close(_id):
+        try:
+            writer.close(_id)
+        except Exception as err:
+            progress.warn(f'Results for query {_id} could not be '
+                          f'written: {err!r}')
+
+    def work(_id, kwargs):
+        rows, failed = 0, False
+        try:
+            rows = run_query(mode, _id, kwargs, writer, limiter)
+        except Exception as err:
+            failed = True
+            fail(_id, err)
+        finally:
+            close(_id)
+            progress.update(rows=rows, failed=failed)
+            slots.release()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for _id, kwargs in queries:
+            if isinstance(kwargs, Exception):
+                fail(_id, kwargs)
+                close(_id)
+                progress.update(failed=True)
+                continue
+            slots.acquire()
+            executor.submit(work, _id, kwargs)
+    progress.report()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='clio-lite',
+                                     description=__doc__.split('\n\n')[0])
+    parser.add_argument('mode', choices=('search', 'keywords', 'iter'))
+    parser.add_argument('--url', help='URL path to bare ES endpoint')
+    parser.add_argument('--index', help='Index to query')
+    parser.add_argument('--fields', nargs='+', default=None,
+                        help='Fields to query')
+    parser.add_argument('--input', default='-',
+                        help='JSONL file of queries ("-" for stdin)')
+    parser.add_argument('--output-dir', default=None,
+                        help='Write results to one file per query id')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Number of concurrent queries')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='Maximum number of queries started per second')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # Command line arguments are defaults for each query
+    defaults = {k: v for k, v in (('url', args.url),
+                                  ('index', args.index),
+                                  ('fields', args.fields))
+                if v is not None}
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+    lines = (sys.stdin if args.input == '-' else open(args.input))
+    try:
+        run_batch(args.mode, read_queries(lines, defaults),
+                  writer=Writer(output_dir=args.output_dir),
+                  progress=Progress(),
+                  workers=args.workers, rate=args.rate)
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,26 +1,175 @@
+from collections import Counter
+from collections import defaultdict
 import json
+import logging
 import requests
 import os
+import threading
 from copy import deepcopy
 from clio_utils import try_pop
-from clio_utils import extract_docs
+from clio_utils import TokenBucket
+from clio_utils import TTLCache
+from clio_utils import UnregisteredEndpointError
+from clio_utils import make_endpoint
+from clio_utils import set_headers
 from clio_utils import unpack_if_safe
-from clio_lite import clio_search
+from clio_lite import STOP_WORDS
+from clio_lite import seed_query
+from clio_lite import make_mlt_search
+from clio_lite import msearch
+from clio_lite import record_shards
+from clio_lite import resolve_search_type
 
 
 def format_response(response):
     """Format the :obj:`requests.Response`, as expected by AWS API Gateway"""
+    return format_data(unpack_if_safe(response), response.status_code)
+
+
+def format_data(data, status_code=200):
+    """Format the raw ES data, as expected by AWS API Gateway"""
     return {
         "isBase64Encoded": False,
-        "statusCode": response.status_code,
+        "statusCode": status_code,
         "headers": {
             "Access-Control-Allow-Origin": "*",
             "Access-Control-Allow-Credentials": True
         },
-        "body": make_es7_safe(response)
+        "body": make_es7_safe(data)
     }
 
 
+def error_response(status_code, message):
+    """Format an error in the same way as :obj:`format_response`"""
+    return {
+        "isBase64Encoded": False,
+        "statusCode": status_code,
+        "headers": {
+            "Access-Control-Allow-Origin": "*",
+            "Access-Control-Allow-Credentials": True
+        },
+        "body": json.dumps({"error": message})
+    }
+
+
+class AdmissionControl:
+    """Per-endpoint admission control for expanded queries, which each
+    make two heavy queries to ES. Expansions are limited by a token bucket
+    and by a cap on the number in flight. Requests over this budget are
+    "degraded" (served a cached or plain non-expanded query instead), and
+    requests over the budget for degraded queries are "shed". Limits
+    of None are unlimited.
+
+    Args:
+        rate (float): Expansions per second, per endpoint.
+        burst (float): Burst size for expansions, per endpoint.
+        max_inflight (int): Maximum concurrent expansions, per endpoint.
+        degraded_rate (float): Degraded queries per second, per endpoint.
+        degraded_burst (float): Burst size for degraded queries.
+    """
+    def __init__(self, rate=None, burst=None, max_inflight=None,
+                 degraded_rate=None, degraded_burst=None):
+        self.rate, self.burst = rate, burst
+        self.max_inflight = max_inflight
+        self.degraded_rate, self.degraded_burst = degraded_rate, degraded_burst
+        self.buckets = {}
+        self.degraded_buckets = {}
+        self.inflight = {}
+        self.metrics = defaultdict(Counter)
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        """Read the limits from the environment variables EXPANSION_RATE,
+        EXPANSION_BURST, MAX_INFLIGHT_EXPANSIONS, DEGRADED_RATE and
+        DEGRADED_BURST (any of which can be omitted)"""
+        def get(name, _type=float):
+            value = os.environ.get(name)
+            return None if value in (None, '') else _type(value)
+        return cls(rate=get('EXPANSION_RATE'),
+                   burst=get('EXPANSION_BURST'),
+                   max_inflight=get('MAX_INFLIGHT_EXPANSIONS', int),
+                   degraded_rate=get('DEGRADED_RATE'),
+                   degraded_burst=get('DEGRADED_BURST'))
+
+    def _get(self, endpoint, items, factory):
+        with self.lock:
+            if endpoint not in items:
+                items[endpoint] = factory()
+            return items[endpoint]
+
+    def admit(self, endpoint):
+        """Try to admit an expansion, which must be
+        :obj:`release`d if admitted."""
+        if self.max_inflight is not None:
+            inflight = self._get(endpoint, self.inflight,
+                                 lambda: threading.BoundedSemaphore(self.max_inflight))
+            if not inflight.acquire(blocking=False):
+                return False
+        if self.rate is not None:
+            bucket = self._get(endpoint, self.buckets,
+                               lambda: TokenBucket(self.rate, self.burst))
+            if not bucket.acquire(blocking=False):
+                self.release(endpoint)
+                return False
+        return True
+
+    def release(self, endpoint):
+        if self.max_inflight is not None:
+            self.inflight[endpoint].release()
+
+    def admit_degraded(self, endpoint):
+        """Try to admit a degraded query"""
+        if self.degraded_rate is None:
+            return True
+        bucket = self._get(endpoint, self.degraded_buckets,
+                           lambda: TokenBucket(self.degraded_rate,
+                                               self.degraded_burst))
+        return bucket.acquire(blocking=False)
+
+    def record(self, endpoint, outcome):
+        """Count an outcome ('expanded', 'cached', 'degraded'
+        or 'shed') for the endpoint"""
+        with self.lock:
+            self.metrics[endpoint][outcome] += 1
+            if outcome in ('degraded', 'shed'):
+                logging.warning(f'Admission control {outcome} a request to '
+                                f'{endpoint}: {dict(self.metrics[endpoint])}')
+
+    def snapshot(self):
+        """A copy of the metrics, per endpoint"""
+        with self.lock:
+            return {endpoint: dict(counts)
+                    for endpoint, counts in self.metrics.items()}
+
+
+"""Admission control and facet cache for the lambda, which persist
+across warm invocations. Note that these are per container, so the
+admission limits don't cap the total load on ES (use reserved
+concurrency for that), and MAX_INFLIGHT_EXPANSIONS has no effect."""
+ADMISSION = None
+FACET_CACHE = None
+
+
+def default_admission():
+    global ADMISSION
+    if ADMISSION is None:
+        ADMISSION = AdmissionControl.from_env()
+    return ADMISSION
+
+
+def default_facet_cache():
+    """Facet cache for the lambda, with lifetime FACET_CACHE_TTL
+    (seconds, 0 to disable) and size FACET_CACHE_SIZE"""
+    global FACET_CACHE
+    ttl = float(os.environ.get('FACET_CACHE_TTL', 60))
+    if FACET_CACHE is None and ttl > 0:
+        FACET_CACHE = TTLCache(maxsize=int(os.environ.get('FACET_CACHE_SIZE',
+                                                          1000)),
+                               ttl=ttl)
+    return FACET_CACHE
+
+
 def extract_fields(q):
     """Extract which fields are being interrogated
     by the default searchkit request"""
@@ -37,20 +186,157 @@ def pop_upper_lim(post_filter):
             post_filter[field].pop('lte')
 
 
-def make_es7_safe(r):
+def make_es7_safe(data):
     """Fix hits.total.value breaking change from ES 6.x --> 7.x"""
-    data = unpack_if_safe(r)
     total = data['hits']['total']
     if type(total) is dict:
         data['hits']['total'] = total['value']
     return json.dumps(data)
 
 
-def lambda_handler(event, context=None):
-    """The 'main' function: Process the API Gateway Event
-    passed to Lambda by
-    performing an expansion on the original ES query."""
+"""Headers which identify the caller to ES, so must be part of any cache key"""
+AUTH_HEADERS = ('authorization', 'cookie', 'x-api-key',
+                'x-amz-security-token', 'es-security-runas-user')
+
+
+def auth_headers(headers):
+    """Extract the headers which identify the caller"""
+    return sorted((k.lower(), v) for k, v in headers.items()
+                  if k.lower() in AUTH_HEADERS)
+
+
+def make_cache_key(endpoint, slug, body, headers):
+    """Key for caching the response to a request, so that responses
+    are never shared between callers with different credentials"""
+    return json.dumps([endpoint, slug, json.loads(body),
+                       auth_headers(headers)], sort_keys=True)
+
+
+def make_facet_key(endpoint, mlt_query, aggs, search_type, headers):
+    """Key for caching the facets of an expansion: the aggregations
+    are independent of the hits page, sorting and post_filter. As for
+    :obj:`make_cache_key`, facets are never shared between callers
+    with different credentials."""
+    return json.dumps([endpoint, mlt_query, aggs, search_type,
+                       auth_headers(headers)], sort_keys=True)
+
+
+def expand_search(url, index, query, sk_query, fields, limit, offset,
+                  min_term_freq, max_query_terms, min_doc_frac,
+                  max_doc_frac, min_should_match,
+                  search_type='dfs_query_then_fetch', adaptive_seeds=False,
+                  min_seed_score_frac=0.5, facet_cache=None, session=None,
+                  **kwargs):
+    """Perform the expansion of a searchkit query, as for
+    :obj:`clio_search`. Only the final request differs: the hits page
+    and the facet aggregations are requested in parallel (via _msearch),
+    and the facets are cached per expansion so that paging or sorting
+    only needs to retrieve the hits page.
+
+    Args:
+        url (str): URL path to bare ES endpoint.
+        index (str): Index to query.
+        query (dict): The seed query.
+        sk_query (dict): The remainder of the searchkit query (e.g.
+                         post_filter, aggs, sort, highlight).
+        facet_cache (TTLCache): Cache for facet aggregations.
+        See :obj:`clio_search` for the other arguments.
+    Returns:
+        response (dict): See :obj:`format_response`.
+    """
+    set_headers(kwargs)
+    endpoint = make_endpoint(url, index)
+    # Make the seed query
+    total, docs = seed_query(endpoint=endpoint, query=query,
+                             fields=fields, filters=[],
+                             adaptive_seeds=adaptive_seeds,
+                             min_seed_score_frac=min_seed_score_frac,
+                             response_mode=True, session=session,
+                             search_type=search_type, **kwargs)
+    # No hits, so return the (empty) seed response
+    if total == 0:
+        return format_response(docs)
+    mlt_query, params = make_mlt_search(endpoint=endpoint, docs=docs,
+                                        fields=fields, limit=limit,
+                                        offset=offset,
+                                        min_term_freq=min_term_freq,
+                                        max_query_terms=max_query_terms,
+                                        min_doc_frac=min_doc_frac,
+                                        max_doc_frac=max_doc_frac,
+                                        min_should_match=min_should_match,
+                                        total=total, stop_words=STOP_WORDS,
+                                        search_type=search_type)
+
+    # Split the searchkit query into the hits page and the facets
+    sk_query = dict(sk_query)
+    aggs = try_pop(sk_query, 'aggs', try_pop(sk_query, 'aggregations'))
+    hits_query = dict(sk_query, **mlt_query)
+
+    # Retrieve the facets from the cache, if possible
+    facets = None
+    if aggs is not None and facet_cache is not None:
+        facet_key = make_facet_key(endpoint, mlt_query['query'], aggs,
+                                   search_type, kwargs.get('headers', {}))
+        facets = facet_cache.get(facet_key)
+
+    # Only the hits page is required
+    if aggs is None or facets is not None:
+        logging.debug(hits_query)
+        r = (session or requests).post(url=endpoint,
+                                       data=json.dumps(hits_query),
+                                       params=params, **kwargs)
+        if search_type == 'auto':
+            record_shards(endpoint, r)
+        data = unpack_if_safe(r)
+        if facets is not None:
+            data['aggregations'] = deepcopy(facets)
+        return format_data(data, r.status_code)
+
+    # Otherwise, retrieve the hits page and facets in parallel
+    aggs_query = {"query": mlt_query['query'], "size": 0,
+                  "aggregations": aggs}
+    aggs_search_type = resolve_search_type(search_type, endpoint,
+                                           aggregation=True)
+    data, aggs_data = msearch(make_endpoint(url, index, api='_msearch'),
+                              bodies=[hits_query, aggs_query],
+                              search_types=[params['search_type'],
+                                            aggs_search_type],
+                              session=session, **kwargs)
+    if search_type == 'auto':
+        record_shards(endpoint, data)
+    # Keep the same shape as a plain _search response
+    data.pop('status', None)
+    facets = aggs_data.get('aggregations', {})
+    if facet_cache is not None:
+        facet_cache.set(facet_key, deepcopy(facets))
+    data['aggregations'] = facets
+    return format_data(data)
 
+
+def handle_event(event, scheme='https', session=None, cache=None,
+                 admission=None, stale_grace=300, facet_cache=None):
+    """Process an API Gateway-style event by
+    performing an expansion on the original ES query.
+
+    Args:
+        event (dict): The event, with 'body', 'headers' and
+                      'pathParameters'.
+        scheme (str): Scheme with which to connect to the ES endpoint.
+        session (requests.Session): Session (i.e. connection pool) with which
+                                    to make requests, if not :obj:`requests`.
+        cache (TTLCache): Cache for the responses to expanded queries.
+        admission (AdmissionControl): Admission control for expansions.
+                                      Defaults to limits set in the
+                                      environment.
+        stale_grace (float): Number of seconds after expiry for which
+                             cached responses can still be served when
+                             over the expansion budget.
+        facet_cache (TTLCache): Cache for facet aggregations.
+    Returns:
+        response (dict): See :obj:`format_response`.
+    """
+    if admission is None:
+        admission = default_admission()
     query = json.loads(event['body'])
 
     # Strip out any extreme upper limits from the post_filter
@@ -71,20 +357,29 @@ def lambda_handler(event, context=None):
     # won't match the lambda host
     if 'Host' in event['headers']:
         event['headers'].pop('Host')
-        
+
     # Generate the endpoint URL, and validate
     endpoint = event['headers'].pop('es-endpoint')
     if endpoint not in os.environ['ALLOWED_ENDPOINTS'].split(";"):
-        raise ValueError(f'{endpoint} has not been registered')
+        raise UnregisteredEndpointError(f'{endpoint} has not been registered')
     slug = event['pathParameters']['proxy']
+    url = f"{scheme}://{endpoint}/{slug}"
     # If not a search query, return
     if not slug.endswith("_search") or 'query' not in query:
-        url = f"https://{endpoint}/{slug}"
-        r = requests.post(url, data=json.dumps(query),
-                          params={"rest_total_hits_as_int": "true"},
-                          headers=event['headers'])
+        r = (session or requests).post(url, data=json.dumps(query),
+                                       params={"rest_total_hits_as_int": "true"},
+                                       headers=event['headers'])
         return format_response(r)
 
+    # Check for a recent identical expansion
+    if cache is not None:
+        cache_key = make_cache_key(endpoint, slug, event['body'],
+                                   event['headers'])
+        response = cache.get(cache_key)
+        if response is not None:
+            admission.record(endpoint, 'cached')
+            return deepcopy(response)
+
     # Convert the request info ready for clio_search
     index = slug[:-8]  # removes "/_search"
     limit = try_pop(query, 'size')
@@ -94,21 +389,62 @@ def lambda_handler(event, context=None):
     min_doc_frac = try_pop(query, 'min_doc_frac', 0.001)
     max_doc_frac = try_pop(query, 'max_doc_frac', 0.90)
     min_should_match = try_pop(query, 'minimum_should_match', 0.2)
+    adaptive_seeds = try_pop(query, 'adaptive_seeds', False)
+    min_seed_score_frac = try_pop(query, 'min_seed_score_frac', 0.5)
+    search_type = try_pop(query, 'search_type',
+                          os.environ.get('SEARCH_TYPE', 'dfs_query_then_fetch'))
     old_query = deepcopy(try_pop(query, 'query'))
     fields = extract_fields(old_query)
 
+    # If over budget, serve a stale cached result or a plain query
+    if not admission.admit(endpoint):
+        response = (None if cache is None else
+                    cache.get(cache_key, grace=stale_grace))
+        if response is not None:
+            admission.record(endpoint, 'cached')
+            return deepcopy(response)
+        if not admission.admit_degraded(endpoint):
+            admission.record(endpoint, 'shed')
+            return error_response(429, 'Too many requests')
+        admission.record(endpoint, 'degraded')
+        plain_query = dict(query, query=old_query)
+        for k, v in (('size', limit), ('from', offset)):
+            if v is not None:
+                plain_query[k] = v
+        r = (session or requests).post(url, data=json.dumps(plain_query),
+                                       params={"rest_total_hits_as_int": "true"},
+                                       headers=event['headers'])
+        return format_response(r)
+
     # Make the search
-    _, r = clio_search(f"https://{endpoint}", index, old_query,
-                       fields=fields,
-                       limit=limit,
-                       offset=offset,
-                       min_term_freq=min_term_freq,
-                       max_query_terms=max_query_terms,
-                       min_doc_frac=min_doc_frac,
-                       max_doc_frac=max_doc_frac,
-                       min_should_match=min_should_match,
-                       post_aggregation=query,
-                       response_mode=True,
-                       headers=event['headers'])
-
-    return format_response(r)
+    try:
+        response = expand_search(f"{scheme}://{endpoint}", index, old_query,
+                                 sk_query=query,
+                                 fields=fields,
+                                 limit=limit,
+                                 offset=offset,
+                                 min_term_freq=min_term_freq,
+                                 max_query_terms=max_query_terms,
+                                 min_doc_frac=min_doc_frac,
+                                 max_doc_frac=max_doc_frac,
+                                 min_should_match=min_should_match,
+                                 search_type=search_type,
+                                 adaptive_seeds=adaptive_seeds,
+                                 min_seed_score_frac=min_seed_score_frac,
+                                 facet_cache=facet_cache,
+                                 session=session,
+                                 headers=event['headers'])
+    finally:
+        admission.release(endpoint)
+    admission.record(endpoint, 'expanded')
+
+    if cache is not None and response['statusCode'] == 200:
+        cache.set(cache_key, deepcopy(response))
+    return response
+
+
+def lambda_handler(event, context=None):
+    """The 'main' function: Process the API Gateway Event
+    passed to Lambda by
+    performing an expansion on the original ES query."""
+    return handle_event(event, facet_cache=default_facet_cache())
@@ -0,0 +1,241 @@
+"""
+A standalone, long-lived HTTP proxy server with the same searchkit-compatible
+behaviour as :obj:`clio_lite_searchkit_lambda`, for running on your own hosts
+rather than on AWS Lambda.
+
+Requests are served concurrently from an asyncio event loop, and the
+Elasticsearch requests are made from a pool of worker threads which share
+a single connection pool and response cache. As for the lambda, the
+environment variables ALLOWED_ENDPOINTS and RANGE_UPPER_LIMIT must be set,
+and admission control limits are read from the environment (see
+:obj:`AdmissionControl.from_env`). Admission control metrics are served
+from /_clio/metrics.
+
+e.g. :obj:`python clio_lite_server.py --port 8000 --scheme http`
+"""
+
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import json
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+
+from clio_utils import ElasticsearchError
+from clio_utils import UnregisteredEndpointError
+from clio_utils import TTLCache
+from clio_lite_searchkit_lambda import handle_event
+from clio_lite_searchkit_lambda import error_response
+from clio_lite_searchkit_lambda import AdmissionControl
+
+
+"""Headers which aren't forwarded to Elasticsearch"""
+HOP_HEADERS = {'host', 'connection', 'keep-alive', 'content-length',
+               'transfer-encoding', 'te', 'upgrade', 'proxy-connection'}
+
+STATUS_REASONS = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden',
+                  404: 'Not Found', 429: 'Too Many Requests',
+                  500: 'Internal Server Error',
+                  502: 'Bad Gateway'}
+
+CORS_HEADERS = {"Access-Control-Allow-Origin": "*",
+                "Access-Control-Allow-Credentials": "true",
+                "Access-Control-Allow-Headers": "*",
+                "Access-Control-Allow-Methods": "GET, POST, OPTIONS"}
+
+
+def make_session(pool_size):
+    """Make a :obj:`requests.Session` with a connection pool
+    large enough for every worker thread"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def make_event(path, headers, body):
+    """Convert the raw HTTP request into an API Gateway-style event,
+    as expected by :obj:`handle_event`."""
+    _headers = {}
+    for k, v in headers.items():
+        if k.lower() in HOP_HEADERS:
+            continue
+        if k.lower() == 'es-endpoint':
+            k = 'es-endpoint'
+        _headers[k] = v
+    return {'body': body.decode() if body else '{}',
+            'headers': _headers,
+            'pathParameters': {'proxy': path.split('?')[0].strip('/')}}
+
+
+async def read_request(reader):
+    """Read a single HTTP request from the stream.
+
+    Returns:
+        {method, path, headers, body} (tuple), or None if the
+        connection was closed.
+    """
+    line = await reader.readline()
+    if not line.strip():
+        return None
+    method, path, _ = line.decode('latin-1').split(' ', 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        k, v = line.decode('latin-1').split(':', 1)
+        headers[k.strip()] = v.strip()
+    length = int(next((v for k, v in headers.items()
+                       if k.lower() == 'content-length'), 0))
+    body = await reader.readexactly(length) if length > 0 else b''
+    return method, path, headers, body
+
+
+def write_response(writer, response, keep_alive):
+    """Write the output of :obj:`format_response` as an HTTP response"""
+    body = response['body'].encode()
+    status_code = response['statusCode']
+    headers = dict(CORS_HEADERS,
+                   **{k: str(v).lower() if type(v) is bool else str(v)
+                      for k, v in response['headers'].items()})
+    headers['Content-Type'] = 'application/json'
+    headers['Content-Length'] = str(len(body))
+    headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+    reason = STATUS_REASONS.get(status_code, '')
+    lines = [f'HTTP/1.1 {status_code} {reason}']
+    lines += [f'{k}: {v}' for k, v in headers.items()]
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+
+
+class ProxyServer:
+    """Searchkit-compatible proxy server, sharing a connection pool,
+    a worker pool and a response cache across all requests.
+
+    Args:
+        scheme (str): Scheme with which to connect to ES endpoints.
+        workers (int): Number of concurrent ES requests.
+        cache_size (int): Maximum number of expanded responses (and, separately,
+                          facets) to cache.
+        cache_ttl (float): Lifetime of cached responses and facets, in
+                           seconds (0 to disable caching).
+        admission (AdmissionControl): Admission control for expansions.
+                                      Defaults to limits set in the
+                                      environment.
+    """
+    def __init__(self, scheme='https', workers=16,
+                 cache_size=1000, cache_ttl=60, admission=None):
+        self.scheme = scheme
+        self.admission = admission or AdmissionControl.from_env()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.session = make_session(workers)
+        self.cache = (TTLCache(maxsize=cache_size, ttl=cache_ttl)
+                      if cache_ttl > 0 else None)
+        self.facet_cache = (TTLCache(maxsize=cache_size, ttl=cache_ttl)
+                            if cache_ttl > 0 else None)
+
+    async def respond(self, method, path, headers, body):
+        """Generate the response for a single request"""
+        if method == 'OPTIONS':  # CORS preflight
+            return {"statusCode": 200, "headers": {}, "body": ""}
+        if method == 'GET' and path.split('?')[0] == '/_clio/metrics':
+            return {"statusCode": 200, "headers": {},
+                    "body": json.dumps(self.admission.snapshot())}
+        if not any(k.lower() == 'es-endpoint' for k in headers):
+            return error_response(400, 'Missing es-endpoint header')
+        event = make_event(path, headers, body)
+        handler = functools.partial(handle_event, event,
+                                    scheme=self.scheme,
+                                    session=self.session,
+                                    cache=self.cache,
+                                    facet_cache=self.facet_cache,
+                                    admission=self.admission)
+        loop = asyncio.get_event_loop()
+        try:
+            return await loop.run_in_executor(self.executor, handler)
+        except UnregisteredEndpointError as err:
+            return error_response(403, str(err))
+        except (ElasticsearchError, requests.RequestException) as err:
+            return error_response(502, str(err))
+        except ValueError as err:  # e.g. malformed body or parameters
+            return error_response(400, str(err))
+        except Exception as err:
+            logging.exception(err)
+            return error_response(500, repr(err))
+
+    async def handle_connection(self, reader, writer):
+        """Serve requests on the connection until it is closed"""
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                except (ValueError, asyncio.IncompleteReadError):
+                    write_response(writer, error_response(400, 'Bad request'),
+                                   keep_alive=False)
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+                keep_alive = not any(k.lower() == 'connection' and
+                                     v.lower() == 'close'
+                                     for k, v in headers.items())
+                response = await self.respond(method, path, headers, body)
+                write_response(writer, response, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=8000):
+        """Start listening, returning the :obj:`asyncio.AbstractServer`"""
+        return await asyncio.start_server(self.handle_connection, host, port)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.session.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='clio-lite-server',
+                                     description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--scheme', default='https', choices=('http', 'https'),
+                        help='Scheme with which to connect to ES endpoints')
+    parser.add_argument('--workers', type=int, default=16,
+                        help='Number of concurrent ES requests')
+    parser.add_argument('--cache-size', type=int, default=1000,
+                        help='Maximum number of expanded responses to cache')
+    parser.add_argument('--cache-ttl', type=float, default=60,
+                        help='Lifetime of cached responses in seconds '
+                             '(0 to disable caching)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    proxy = ProxyServer(scheme=args.scheme, workers=args.workers,
+                        cache_size=args.cache_size, cache_ttl=args.cache_ttl)
+
+    # Python 3.6 compatible, i.e. no asyncio.run or serve_forever
+    loop = asyncio.get_event_loop()
+    server = loop.run_until_complete(proxy.start(args.host, args.port))
+    logging.info(f'Serving on {args.host}:{args.port}')
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        proxy.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+"""
+Standing (i.e. regularly repeated) contextual searches, which only search
+documents ingested since the previous run.
+
+The resolved expansion of each query (the seed docs and the MLT
+hyperparameters) is persisted, along with a watermark on an ingest
+timestamp or sequence field. On each run only the expanded query is
+made, restricted to documents past the watermark, after which the
+watermark is advanced. The seed query is only rerun once the expansion
+is older than :obj:`max_seed_age`.
+
+e.g.
+
+    standing = StandingQueries('standing.json', url=url, index=index,
+                               watermark_field='date_ingested')
+    standing.add('bert', query='BERT', fields=['title_of_article'])
+    new_docs = standing.run_all()  # Run daily
+"""
+
+import json
+import logging
+import os
+import requests
+import time
+
+from clio_utils import set_headers
+from clio_utils import make_endpoint
+from clio_utils import unpack_if_safe
+from clio_lite import STOP_WORDS
+from clio_lite import simple_query
+from clio_lite import more_like_this
+from clio_lite import ScrollManager
+
+
+"""Default MLT hyperparameters, as for :obj:`clio_search`"""
+MLT_DEFAULTS = dict(min_term_freq=1, max_query_terms=10,
+                    min_doc_frac=0.001, max_doc_frac=0.9,
+                    min_should_match=0.1)
+
+
+def max_value(endpoint, field, **kwargs):
+    """Retrieve the maximum value of a field over the whole index.
+
+    Args:
+        endpoint (str): URL path to _search endpoint
+        field (str): A numeric or date field.
+    Returns:
+        value: The maximum value (epoch millis for dates), or None
+               if the index is empty.
+    """
+    _query = {"size": 0, "aggregations": {"_max": {"max": {"field": field}}}}
+    r = requests.post(url=endpoint, data=json.dumps(_query), **kwargs)
+    data = unpack_if_safe(r)
+    return data['aggregations']['_max']['value']
+
+
+class StandingQueries:
+    """A persisted set of standing queries against a single index.
+
+    Args:
+        path (str): JSON file in which to persist the queries.
+        url (str): URL path to bare ES endpoint.
+        index (str): Index to query.
+        watermark_field (str): Ingest timestamp or sequence field, which
+                               increases for newly ingested documents.
+        max_seed_age (float): Number of seconds after which to rerun the
+                              seed query of each standing query.
+        chunksize (int): Chunk size to retrieve from Elasticsearch.
+        scroll (str): ES scroll time window (e.g. '1m').
+        lag (float): Hold the high watermark back by this much (in units
+                     of the watermark field, i.e. epoch millis for dates),
+                     so that documents which weren't yet searchable at run
+                     time (e.g. due to refresh or ingest pipeline lag) are
+                     found on the next run, rather than missed.
+        kwargs: Any bonus kwargs to pass in the POST requests to ES.
+    """
+    def __init__(self, path, url, index, watermark_field,
+                 max_seed_age=7*24*60*60, chunksize=1000,
+                 scroll='1m', lag=0, **kwargs):
+        set_headers(kwargs)
+        self.path = path
+        self.url = url
+        self.endpoint = make_endpoint(url, index)
+        self.watermark_field = watermark_field
+        self.max_seed_age = max_seed_age
+        self.chunksize = chunksize
+        self.scroll = scroll
+        self.lag = lag
+        self.kwargs = kwargs
+        self.queries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.queries = json.load(f)
+
+    def save(self):
+        """Persist the queries, replacing the file atomically"""
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.queries, f)
+        os.replace(tmp_path, self.path)
+
+    def add(self, name, query, fields=[], n_seed_docs=None,
+            pre_filters=[], post_filters=[], stop_words=STOP_WORDS,
+            watermark=None, **mlt_params):
+        """Register a standing query. Arguments are as for
+        :obj:`clio_search`, and :obj:`watermark` is the value of the
+        watermark field after which to search (by default, only documents
+        ingested after the first run are found), in any format which ES
+        accepts for the field (e.g. '2026-01-01' for a date)."""
+        self.queries[name] = dict(query=query, fields=fields,
+                                  n_seed_docs=n_seed_docs,
+                                  pre_filters=pre_filters,
+                                  post_filters=post_filters,
+                                  stop_words=stop_words,
+                                  mlt_params=dict(MLT_DEFAULTS, **mlt_params),
+                                  seed=None, watermark=watermark)
+        self.save()
+
+    def remove(self, name):
+        self.queries.pop(name)
+        self.save()
+
+    def reseed(self, name):
+        """Rerun the seed query, and store the resolved seed docs"""
+        info = self.queries[name]
+        total, docs = simple_query(endpoint=self.endpoint,
+                                   query=info['query'],
+                                   fields=info['fields'],
+                                   size=info['n_seed_docs'],
+                                   filters=info['pre_filters'],
+                                   **self.kwargs)
+        info['seed'] = dict(total=total, docs=docs, created=time.time())
+
+    def run(self, name, high_watermark=None):
+        """Find documents matching the standing query which were
+        ingested since the last run, and advance the watermark.
+
+        Args:
+            name (str): Name of the standing query.
+            high_watermark: The current maximum of the watermark field
+                            (retrieved from ES if not specified).
+        Returns:
+            {total, docs} (tuple): {total number of new docs}, {new docs}.
+        """
+        info = self.queries[name]
+        if high_watermark is None:
+            high_watermark = max_value(self.endpoint, self.watermark_field,
+                                       **self.kwargs)
+        if high_watermark is not None and self.lag:
+            high_watermark -= self.lag
+        # Nothing can be new on the first run or for an empty index
+        low_watermark = info['watermark']
+        if low_watermark is None or high_watermark is None:
+            info['watermark'] = high_watermark
+            self.save()
+            return 0, []
+
+        # Only rerun the seed query once stale
+        seed = info['seed']
+        if seed is None or time.time() - seed['created'] > self.max_seed_age:
+            self.reseed(name)
+            seed = info['seed']
+
+        # Expand only over the newly ingested docs
+        window = {"range": {self.watermark_field: {"gt": low_watermark,
+                                                   "lte": high_watermark}}}
+        docs = []
+        # The watermarks are compared by ES rather than here, since the
+        # initial watermark may be in another format (e.g. a date string)
+        if low_watermark != high_watermark:
+            scroll_id, _docs = more_like_this(endpoint=self.endpoint,
+                                              docs=seed['docs'],
+                                              fields=info['fields'],
+                                              limit=self.chunksize,
+                                              offset=None,
+                                              total=seed['total'],
+                                              stop_words=info['stop_words'],
+                                              filters=info['post_filters'] + [window],
+                                              scroll=self.scroll,
+                                              **info['mlt_params'],
+                                              **self.kwargs)
+            with ScrollManager(url=self.url, scroll_id=scroll_id,
+                               docs=_docs, chunksize=self.chunksize,
+                               scroll=self.scroll,
+                               headers=self.kwargs.get('headers')) as pages:
+                for page in pages:
+                    docs += page
+        logging.info(f'Standing query "{name}" found {len(docs)} new docs '
+                     f'in ({low_watermark}, {high_watermark}]')
+        info['watermark'] = high_watermark
+        self.save()
+        return len(docs), docs
+
+    def run_all(self):
+        """Run every standing query against the same watermark.
+
+        Returns:
+            results (dict): {total, docs} (tuple) for each query name.
+        """
+        high_watermark = max_value(self.endpoint, self.watermark_field,
+                                   **self.kwargs)
+        return {name: self.run(name, high_watermark=high_watermark)
+                for name in list(self.queries)}
@@ -1,4 +1,8 @@
+from collections import defaultdict
+from collections import OrderedDict
 import json
+import threading
+import time
 import urllib
 
 
@@ -6,6 +10,10 @@ class ElasticsearchError(Exception):
     pass
 
 
+class UnregisteredEndpointError(ValueError):
+    pass
+
+
 def set_headers(kwargs):
     """Set standard headers here"""
     if 'headers' not in kwargs:
@@ -13,12 +21,13 @@ def set_headers(kwargs):
     kwargs["headers"]["Content-Type"] = "application/json"
 
 
-def make_endpoint(url, index):
-    """Combine the endpoint URL and index into the _search endpoint path"""
+def make_endpoint(url, index, api='_search'):
+    """Combine the endpoint URL and index into the :obj:`api`
+    (by default _search) endpoint path"""
     endpoint = url
     if index is not None:
         endpoint = urllib.parse.urljoin(f'{endpoint}/', index)
-    endpoint = urllib.parse.urljoin(f'{endpoint}/', '_search')
+    endpoint = urllib.parse.urljoin(f'{endpoint}/', api)
     return endpoint
 
 
@@ -50,6 +59,28 @@ def unpack_if_safe(r):
     return data
 
 
+def extract_responses(r):
+    """Extract the individual responses from an _msearch
+    :obj:`requests.Response`, raising if any of them failed."""
+    data = unpack_if_safe(r)
+    responses = data['responses']
+    for response in responses:
+        if 'error' in response:
+            raise ElasticsearchError("Failed with _msearch query "
+                                     f"{r.request.body}"
+                                     f"\n\nResponse from ES was {response}")
+    return responses
+
+
+def extract_total(data):
+    """Extract hits.total from the raw ES data, allowing
+    for the breaking change from ES 6.x --> 7.x"""
+    total = data['hits']['total']
+    if type(total) is dict:
+        total = total['value']
+    return total
+
+
 def extract_keywords(r, agg_name='_keywords'):
     data = unpack_if_safe(r)
     return data['aggregations'][agg_name]['keywords']['buckets']
@@ -77,7 +108,142 @@ def extract_docs(r, scroll=None, include_score=False):
     return total, docs
 
 
+def summarise_profile(data, top_n=5):
+    """Condense the per-shard profile trees from an ES response
+    (made with "profile": true) into a compact summary. Times are in
+    milliseconds, summed over shards.
+
+    Args:
+        data (dict): The raw ES data.
+        top_n (int): Number of most expensive query components to report.
+    Returns:
+        summary (dict): The ES latency ("took"), the time split between
+                        the dfs, query, fetch and aggregation phases
+                        ("time"), the most expensive query and aggregation
+                        components ("top_components") and the terms which
+                        were queried ("terms"), e.g. those selected by MLT.
+    """
+    phase_nanos = defaultdict(int)
+    components = defaultdict(int)
+    terms = set()
+
+    def walk(node, kind):
+        components[(kind, node['type'], node['description'])] += node['time_in_nanos']
+        if node['type'] == 'TermQuery':
+            terms.add(node['description'])
+        for child in node.get('children', []):
+            walk(child, kind)
+
+    for shard in data.get('profile', {}).get('shards', []):
+        # The dfs phase is only profiled from ES 8.x
+        dfs = shard.get('dfs', {}).get('statistics', {})
+        phase_nanos['dfs'] += dfs.get('time_in_nanos', 0)
+        for search in shard['searches']:
+            phase_nanos['query'] += search.get('rewrite_time', 0)
+            for node in search['query']:
+                phase_nanos['query'] += node['time_in_nanos']
+                walk(node, 'query')
+        for node in shard.get('aggregations', []):
+            phase_nanos['aggregations'] += node['time_in_nanos']
+            walk(node, 'aggregation')
+        # The fetch phase is only profiled from ES 7.16
+        phase_nanos['fetch'] += shard.get('fetch', {}).get('time_in_nanos', 0)
+
+    top_components = sorted(components.items(), key=lambda item: item[1],
+                            reverse=True)[:top_n]
+    return {'took': data.get('took'),
+            'time': {phase: phase_nanos[phase]/1e6 for phase in
+                     ('dfs', 'query', 'fetch', 'aggregations')},
+            'top_components': [dict(kind=kind, type=_type,
+                                    description=description[:200],
+                                    time=nanos/1e6)
+                               for (kind, _type, description), nanos
+                               in top_components],
+            'terms': sorted(terms)}
+
+
 def assert_fraction(x, name='value'):
     if not (0 < x <= 1):
         raise ValueError(f'{name} must be > 0 and <= 1. '
                          f'Invalid value of "{x}" was provided')
+
+
+class TokenBucket:
+    """A thread-safe token bucket, for rate limiting.
+
+    Args:
+        rate (float): Number of tokens added per second.
+        capacity (float): Maximum number of tokens (i.e. the burst size).
+                          Defaults to :obj:`rate`.
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = max(capacity or rate, 1)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.last)*self.rate)
+        self.last = now
+
+    def acquire(self, blocking=True):
+        """Take a token, waiting for one if :obj:`blocking`.
+
+        Returns:
+            acquired (bool): Whether a token was taken.
+        Raises:
+            ValueError: If blocking on an empty bucket which is never
+                        refilled (i.e. :obj:`rate` is 0).
+        """
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                if not blocking:
+                    return False
+                if self.rate <= 0:
+                    raise ValueError('Token bucket with rate 0 is empty, '
+                                     'and would block forever')
+                wait = (1 - self.tokens)/self.rate
+            time.sleep(wait)
+
+
+class TTLCache:
+    """A thread-safe, size-limited cache whose entries expire after
+    :obj:`ttl` seconds. The least recently used entry is evicted
+    when the cache is full.
+
+    Args:
+        maxsize (int): Maximum number of entries.
+        ttl (float): Lifetime of each entry, in seconds.
+    """
+    def __init__(self, maxsize=1000, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None, grace=0):
+        """Get an entry, allowing for entries which expired less
+        than :obj:`grace` seconds ago (e.g. when under load)."""
+        with self.lock:
+            try:
+                expires, value = self.data[key]
+            except KeyError:
+                return default
+            if expires + grace < time.monotonic():
+                return default
+            self.data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = (time.monotonic() + self.ttl, value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
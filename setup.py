@@ -31,5 +31,9 @@ common_kwargs = dict(
 
 setup(name='clio_lite',
       packages=['.'],
+      entry_points={
+          'console_scripts': ['clio-lite=clio_lite_cli:main',
+                              'clio-lite-server=clio_lite_server:main'],
+      },
       **common_kwargs)
 
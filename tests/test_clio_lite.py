@@ -1,5 +1,6 @@
 import mock
 import pytest
+import threading
 
 #from clio_lite_searchkit_lambda import *
 from clio_utils import try_pop
@@ -7,6 +8,8 @@ from clio_utils import extract_docs
 from clio_utils import assert_fraction
 from clio_utils import set_headers
 from clio_utils import make_endpoint
+from clio_utils import summarise_profile
+from clio_utils import TokenBucket
 
 from clio_lite import simple_query as c_simple_query
 from clio_lite import more_like_this as c_more_like_this
@@ -14,6 +17,10 @@ from clio_lite import clio_search as c_search
 from clio_lite import clio_search_iter
 from clio_lite import combined_score
 from clio_lite import clio_keywords
+from clio_lite import clio_sweep
+from clio_lite import ScrollManager
+from clio_lite import resolve_search_type
+from clio_lite import select_seeds
 
 
 @pytest.fixture
@@ -247,6 +254,9 @@ def test_search(mocked_mlt_query, mocked_simple_query):
                            query=kwargs['query'],
                            fields=kwargs['fields'],
                            filters=kwargs['pre_filters'],
+                           profile=False,
+                           search_type='dfs_query_then_fetch',
+                           include_score=False,
                            bonus_kwarg1=kwargs['bonus_kwarg1'],
                            bonus_kwarg2=kwargs['bonus_kwarg2'])
 
@@ -258,6 +268,103 @@ def test_search(mocked_mlt_query, mocked_simple_query):
     assert _kwargs['bonus_kwarg2'] == kwargs['bonus_kwarg2']
 
 
+@mock.patch('clio_lite.simple_query', return_value=(23, [], 'seed_profile'))
+@mock.patch('clio_lite.more_like_this',
+            return_value=(10, [1, 2, 3], 'mlt_profile'))
+def test_search_profile(mocked_mlt_query, mocked_simple_query):
+    total, docs, profiles = c_search(url='http://www.example.com',
+                                     index='blah', query='something',
+                                     profile=True)
+    assert (total, docs) == (10, [1, 2, 3])
+    assert profiles == {'seed': 'seed_profile', 'expansion': 'mlt_profile',
+                        'n_seed_docs': 0}
+    for mocked in (mocked_simple_query, mocked_mlt_query):
+        _, _kwargs = mocked.call_args
+        assert _kwargs['profile']
+
+
+@mock.patch('clio_lite.requests')
+@mock.patch('clio_lite.unpack_if_safe', return_value={})
+@mock.patch('clio_lite.extract_docs', return_value=(0, []))
+def test_search_profile_response_mode(mocked_extract, mocked_unpack,
+                                      mocked_requests):
+    total, response, profiles = c_search(url='http://www.example.com',
+                                         index='blah', query='something',
+                                         profile=True, response_mode=True)
+    assert total == 0
+    assert response == mocked_requests.post.return_value
+    assert profiles['seed']['took'] is None
+    assert profiles['expansion'] is None
+
+
+def test_select_seeds():
+    def seeds(scores):
+        return [dict(_id=i, _index='idx', _score=score)
+                for i, score in enumerate(scores)]
+    assert select_seeds([]) == []
+    # Cut before the knee
+    selected = select_seeds(seeds([10, 9.5, 9, 2, 1.9, 1.8, 1.7, 1.6]),
+                            min_score_frac=0.01)
+    assert selected == [dict(_id=i, _index='idx') for i in range(3)]
+    # A single strong seed
+    assert len(select_seeds(seeds([10, 1, 0.9, 0.8]),
+                            min_score_frac=0.01)) == 1
+    # Cut at the relative threshold
+    selected = select_seeds(seeds([10, 9, 8, 7, 6, 5, 4, 3]),
+                            min_score_frac=0.75)
+    assert [doc['_id'] for doc in selected] == [0, 1, 2]
+    # Flat scores are all kept
+    assert len(select_seeds(seeds([5]*8))) == 8
+
+
+@mock.patch('clio_lite.ADAPTIVE_SEED_CAP', 7)
+@mock.patch('clio_lite.simple_query')
+@mock.patch('clio_lite.more_like_this', return_value=(10, [1, 2, 3]))
+def test_search_adaptive_seeds(mocked_mlt_query, mocked_simple_query,
+                               caplog):
+    mocked_simple_query.return_value = (100, [dict(_id=i, _index='idx',
+                                                   _score=score)
+                                              for i, score in
+                                              enumerate([10, 9, 1])])
+    with caplog.at_level('INFO'):
+        total, docs, profiles = c_search(url='http://www.example.com',
+                                         index='blah', query='something',
+                                         adaptive_seeds=True)
+    assert (total, docs) == (10, [1, 2, 3])
+    assert profiles == {'seed': None, 'expansion': None, 'n_seed_docs': 2}
+    assert 'Using 2 of 3 seed docs' in caplog.text
+    _, _kwargs = mocked_simple_query.call_args
+    assert _kwargs['size'] == 7
+    assert _kwargs['include_score']
+    _, _kwargs = mocked_mlt_query.call_args
+    assert _kwargs['docs'] == [dict(_id=0, _index='idx'),
+                               dict(_id=1, _index='idx')]
+
+
+def test_summarise_profile():
+    def node(_type, description, nanos, children=[]):
+        return dict(type=_type, description=description,
+                    time_in_nanos=nanos, children=children)
+    mlt = node('BooleanQuery', 'title:bert title:elmo', 3000000,
+               [node('TermQuery', 'title:bert', 2000000),
+                node('TermQuery', 'title:elmo', 1000000)])
+    shard = {'searches': [{'query': [mlt], 'rewrite_time': 500000}],
+             'aggregations': [node('SignificantTextAggregator', 'keywords',
+                                   4000000)],
+             'fetch': {'time_in_nanos': 1000000}}
+    data = {'took': 20, 'profile': {'shards': [shard, shard]}}
+    summary = summarise_profile(data, top_n=2)
+    assert summary['took'] == 20
+    assert summary['time'] == {'dfs': 0, 'query': 7, 'fetch': 2,
+                               'aggregations': 8}
+    assert summary['top_components'] == [
+        dict(kind='aggregation', type='SignificantTextAggregator',
+             description='keywords', time=8),
+        dict(kind='query', type='BooleanQuery',
+             description='title:bert title:elmo', time=6)]
+    assert summary['terms'] == ['title:bert', 'title:elmo']
+
+
 @mock.patch('clio_lite.requests')
 @mock.patch('clio_lite.extract_docs')
 @mock.patch('clio_lite.clio_search')
@@ -275,6 +382,161 @@ def test_search_iter(mocked_search, mocked_extract_docs, mocked_requests):
     assert set(data) == set([0, None, 'a', 'b'])
 
 
+@mock.patch('clio_lite.simple_query', return_value=(1000, ['a', 'b']))
+@mock.patch('clio_lite.msearch')
+def test_sweep(mocked_msearch, mocked_simple_query):
+    def response(ids, total):
+        return {'took': 5, 'hits': {'total': {'value': total},
+                                    'hits': [{'_id': _id} for _id in ids]}}
+    mocked_msearch.return_value = [response(['1', '2', '3', '4'], 100),
+                                   response(['1', '2', '5', '6'], 50),
+                                   response(['7', '8', '9', '10'], 20),
+                                   response([], 0)]
+    param_grid = {'min_should_match': [0.1, 0.5],
+                  'max_query_terms': [10, 20]}
+    table = clio_sweep('http://www.example.com', 'blah', 'something',
+                       param_grid=param_grid, top_k=4)
+    assert mocked_simple_query.call_count == 1  # Seed query only made once
+    assert mocked_msearch.call_count == 1
+    _args, _kwargs = mocked_msearch.call_args
+    assert _args[0] == 'http://www.example.com/blah/_msearch'
+    assert len(_kwargs['bodies']) == 4
+    assert all(body['size'] == 4 for body in _kwargs['bodies'])
+    assert [row['total'] for row in table] == [100, 50, 20, 0]
+    assert [row['overlap'] for row in table] == [1, 0.5, 0, 0]
+    assert [(row['min_should_match'], row['max_query_terms'])
+            for row in table] == [(0.1, 10), (0.1, 20), (0.5, 10), (0.5, 20)]
+    assert all(row['min_doc_frac'] == 0.001 for row in table)
+
+
+@mock.patch('clio_lite.simple_query', return_value=(1000, ['a', 'b']))
+@mock.patch('clio_lite.msearch')
+def test_sweep_count_only(mocked_msearch, mocked_simple_query):
+    mocked_msearch.return_value = [{'took': 3, 'hits': {'total': 10,
+                                                        'hits': []}}]
+    table = clio_sweep('http://www.example.com', 'blah', 'something',
+                       param_grid=[{'min_doc_frac': 0.01}],
+                       count_only=True)
+    _, _kwargs = mocked_msearch.call_args
+    body = _kwargs['bodies'][0]
+    assert body['size'] == 0
+    assert body['track_total_hits']
+    assert table == [dict(min_term_freq=1, max_query_terms=10,
+                          min_doc_frac=0.01, max_doc_frac=0.9,
+                          min_should_match=0.1, total=10,
+                          overlap=None, took=3)]
+
+
+@mock.patch('clio_lite.MAX_CHUNKSIZE', 10)
+@mock.patch('clio_lite.requests')
+@mock.patch('clio_lite.extract_docs')
+@mock.patch('clio_lite.clio_search')
+def test_search_iter_max_chunksize(mocked_search, mocked_extract_docs,
+                                   mocked_requests):
+    mocked_search.return_value = ('an_id', [0]*10)
+    mocked_extract_docs.side_effect = (('an_id', [1]*10), ('an_id', [2]*3))
+    data = list(clio_search_iter('https://something.com', 'an_index',
+                                 chunksize=1000))
+    assert len(data) == 23
+    _, kwargs = mocked_search.call_args
+    assert kwargs['limit'] == 10
+    # The scroll context is cleared once exhausted
+    _, kwargs = mocked_requests.delete.call_args
+    assert kwargs['data'] == '{"scroll_id": ["an_id"]}'
+
+
+@mock.patch('clio_lite.requests')
+@mock.patch('clio_lite.extract_docs')
+def test_scroll_manager_close(mocked_extract_docs, mocked_requests):
+    mocked_extract_docs.return_value = ('another_id', ['a']*10)
+    with ScrollManager('https://something.com', 'an_id',
+                       docs=['a']*10, chunksize=10) as pages:
+        for i, docs in enumerate(pages):
+            if i == 3:
+                break
+    assert mocked_requests.delete.call_count == 1
+    _, kwargs = mocked_requests.delete.call_args
+    assert kwargs['data'] == '{"scroll_id": ["another_id"]}'
+    pages.close()  # Closing is idempotent
+    assert mocked_requests.delete.call_count == 1
+    assert list(pages) == []  # Nothing more once closed, rather than hanging
+
+
+@mock.patch('clio_lite.requests')
+@mock.patch('clio_lite.extract_docs')
+def test_scroll_manager_close_during_fetch(mocked_extract_docs,
+                                           mocked_requests):
+    fetching, closed = threading.Event(), threading.Event()
+
+    def post(*args, **kwargs):
+        fetching.set()
+        closed.wait(1)  # The manager is closed whilst this page is in flight
+    mocked_requests.post.side_effect = post
+    mocked_extract_docs.return_value = ('new_id', ['a']*10)
+    pages = ScrollManager('https://something.com', 'an_id',
+                          docs=['a']*10, chunksize=10)
+    assert fetching.wait(1)
+    pages.close()
+    closed.set()
+    pages.thread.join(1)
+    deleted = [kwargs['data'] for _, kwargs in
+               mocked_requests.delete.call_args_list]
+    assert deleted == ['{"scroll_id": ["an_id"]}',
+                       '{"scroll_id": ["new_id"]}']
+
+
+@mock.patch('clio_lite.requests')
+@mock.patch('clio_lite.extract_docs')
+def test_scroll_manager_error(mocked_extract_docs, mocked_requests):
+    mocked_extract_docs.side_effect = ValueError
+    pages = iter(ScrollManager('https://something.com', 'an_id',
+                               docs=['a']*10, chunksize=10))
+    assert next(pages) == ['a']*10
+    with pytest.raises(ValueError):
+        next(pages)
+    assert mocked_requests.delete.call_count == 1
+
+
+@mock.patch('clio_lite.SHARD_COUNTS', {'single': 1, 'multi': 5})
+@mock.patch('clio_lite.AUTO_DFS_MAX_HITS', 100)
+def test_resolve_search_type():
+    dfs, qtf = 'dfs_query_then_fetch', 'query_then_fetch'
+    for search_type in (dfs, qtf):
+        assert resolve_search_type(search_type, 'single',
+                                   aggregation=True) == search_type
+    with pytest.raises(ValueError):
+        resolve_search_type('dfs', 'multi')
+    assert resolve_search_type('auto', 'multi', aggregation=True) == qtf
+    assert resolve_search_type('auto', 'single') == qtf
+    assert resolve_search_type('auto', 'multi') == dfs
+    assert resolve_search_type('auto', 'unknown') == dfs
+    assert resolve_search_type('auto', 'multi', hits=10) == dfs
+    assert resolve_search_type('auto', 'multi', hits=1000) == qtf
+
+
+@mock.patch('clio_lite.SHARD_COUNTS', {})
+@mock.patch('clio_lite.requests')
+@mock.patch('clio_lite.extract_docs', return_value=(None, None))
+def test_c_simple_query_auto_search_type(mocked_extract, mocked_reqs):
+    mocked_reqs.post.return_value.text = '{"_shards": {"total": 1}}'
+    for expected in ('dfs_query_then_fetch', 'query_then_fetch'):
+        c_simple_query(endpoint='someurl.com', query='a query',
+                       fields=[], filters={}, search_type='auto')
+        _, kwargs = mocked_reqs.post.call_args
+        assert kwargs['params'] == {'search_type': expected}
+
+
+@mock.patch('clio_lite.simple_query', return_value=(0, []))
+@mock.patch('clio_lite.msearch')
+def test_sweep_no_seeds(mocked_msearch, mocked_simple_query):
+    table = clio_sweep('http://www.example.com', 'blah', 'something',
+                       param_grid={'min_should_match': [0.1, 0.5]})
+    assert mocked_msearch.call_count == 0
+    assert [row['min_should_match'] for row in table] == [0.1, 0.5]
+    assert all(row['total'] == 0 and row['overlap'] is None
+               for row in table)
+
+
 def test_try_pop():
     data = {'a': 'A', 'b': 'B', 'c': 'C'}
     assert try_pop(data, 'a', 'AA') == 'A'
@@ -289,6 +551,14 @@ def test_try_pop():
     assert try_pop(data, 'd') is None
 
 
+def test_token_bucket_zero_rate():
+    bucket = TokenBucket(0, 1)
+    assert bucket.acquire(blocking=False)
+    assert not bucket.acquire(blocking=False)  # Never refilled
+    with pytest.raises(ValueError):
+        bucket.acquire()  # Would block forever
+
+
 @mock.patch('clio_utils.json')
 def test_extract_docs(mocked_json):
     mocked_response = mock.MagicMock()
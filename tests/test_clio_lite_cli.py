@@ -0,0 +1,137 @@
+import io
+import json
+import mock
+
+from clio_lite_cli import read_queries
+from clio_lite_cli import run_batch
+from clio_lite_cli import Writer
+from clio_lite_cli import Progress
+from clio_lite_cli import main
+
+
+def test_read_queries():
+    lines = ['{"query": "a", "limit": 3}', '',
+             '{"id": "b", "query": "b", "index": "other"}',
+             'not json']
+    queries = list(read_queries(lines, {'url': 'u', 'index': 'i'}))
+    assert queries[:2] == [(0, {'url': 'u', 'index': 'i',
+                                'query': 'a', 'limit': 3}),
+                           ('b', {'url': 'u', 'index': 'other', 'query': 'b'})]
+    _id, err = queries[2]
+    assert _id == 3
+    assert isinstance(err, ValueError)
+
+
+@mock.patch('clio_lite_cli.clio_search', return_value=(0, []))
+def test_run_batch_bad_lines(mocked_search):
+    stdout, stderr = io.StringIO(), io.StringIO()
+    lines = ['{"query": "a"}', 'not json', '[1]', '{"query": "b"}']
+    progress = Progress(stream=stderr)
+    run_batch('search', read_queries(lines, {}), Writer(stream=stdout),
+              progress)
+    records = {row['id']: row for row in
+               map(json.loads, stdout.getvalue().splitlines())}
+    assert set(records) == {0, 1, 2, 3}
+    assert 'error' in records[1] and 'error' in records[2]
+    assert (progress.done, progress.failed) == (4, 2)
+    assert '4 queries (2 failed)' in stderr.getvalue()
+
+
+@mock.patch('clio_lite_cli.clio_search', return_value=(0, []))
+def test_run_batch_unsafe_ids(mocked_search, tmpdir):
+    out = tmpdir.mkdir('out')
+    queries = [('../escape', {'query': 'a'}), ('a/b', {'query': 'b'})]
+    progress = Progress(stream=io.StringIO())
+    run_batch('search', queries, Writer(output_dir=str(out)), progress)
+    assert sorted(f.basename for f in out.listdir()) == ['___escape.jsonl',
+                                                         'a_b.jsonl']
+    assert not tmpdir.join('escape.jsonl').exists()
+
+
+@mock.patch('clio_lite_cli.clio_search_iter')
+def test_run_batch_colliding_ids(mocked_iter, tmpdir):
+    mocked_iter.side_effect = lambda query: iter([{'_id': query}]*2)
+    out = tmpdir.mkdir('out')
+    queries = [('a.b', {'query': 'x'}), ('a_b', {'query': 'y'}),
+               (3, {'query': 'z'}), ('3', {'query': 'w'})]
+    writer = Writer(output_dir=str(out))
+    run_batch('iter', queries, writer, Progress(stream=io.StringIO()),
+              workers=1)  # i.e. the files are opened in order
+    assert writer.files == {}  # Closed as each query finished
+    records = {}
+    for f in out.listdir():
+        lines = [json.loads(line) for line in f.read().splitlines()]
+        assert len(lines) == 2 and lines[0] == lines[1]
+        records[lines[0]['id']] = (f.basename, lines[0]['doc']['_id'])
+    assert sorted(records.values()) == [('3-1.jsonl', 'w'),
+                                        ('3.jsonl', 'z'),
+                                        ('a_b-1.jsonl', 'y'),
+                                        ('a_b.jsonl', 'x')]
+
+@mock.patch('clio_lite_cli.clio_search', return_value=(0, []))
+def test_run_batch_writer_failure(mocked_search):
+    writer = mock.MagicMock()
+    writer.write.side_effect = OSError('disk full')
+    stderr = io.StringIO()
+    progress = Progress(stream=stderr)
+    run_batch('search', [(0, {'query': 'a'})], writer, progress)
+    assert (progress.done, progress.failed) == (1, 1)
+    assert 'disk full' in stderr.getvalue()
+
+
+@mock.patch('clio_lite_cli.clio_search')
+def test_run_batch(mocked_search):
+    def search(query, **kwargs):
+        if query == 'bad':
+            raise ValueError(query)
+        docs = [{'_id': query}, {'_id': query}]
+        if kwargs.get('adaptive_seeds'):
+            return 2, docs, {'n_seed_docs': 3}
+        return 2, docs
+    mocked_search.side_effect = search
+    stdout, stderr = io.StringIO(), io.StringIO()
+    queries = [(i, {'query': q}) for i, q in enumerate(['a', 'bad', 'c'])]
+    queries[2][1]['adaptive_seeds'] = True
+    progress = Progress(stream=stderr)
+    run_batch('search', queries, Writer(stream=stdout), progress,
+              workers=2, rate=100)
+    records = {row['id']: row for row in
+               map(json.loads, stdout.getvalue().splitlines())}
+    assert records[0] == {'id': 0, 'total': 2,
+                          'docs': [{'_id': 'a'}, {'_id': 'a'}]}
+    assert 'ValueError' in records[1]['error']
+    assert records[2]['total'] == 2
+    assert records[2]['profiles'] == {'n_seed_docs': 3}
+    assert (progress.done, progress.failed, progress.rows) == (3, 1, 4)
+    assert '3 queries (1 failed)' in stderr.getvalue()
+
+
+@mock.patch('clio_lite_cli.clio_keywords')
+def test_run_batch_keywords_profile(mocked_keywords):
+    keywords = [{'key': 'a', 'score': 2}, {'key': 'b', 'score': 1}]
+    mocked_keywords.side_effect = lambda query, profile=False: (
+        (keywords, {'a_field': 'a_profile'}) if profile else keywords)
+    stdout = io.StringIO()
+    queries = [(0, {'query': 'x'}), (1, {'query': 'y', 'profile': True})]
+    progress = Progress(stream=io.StringIO())
+    run_batch('keywords', queries, Writer(stream=stdout), progress)
+    records = {row['id']: row for row in
+               map(json.loads, stdout.getvalue().splitlines())}
+    assert records[0] == {'id': 0, 'keywords': keywords}
+    assert records[1] == {'id': 1, 'keywords': keywords,
+                          'profiles': {'a_field': 'a_profile'}}
+    assert progress.rows == 4
+
+@mock.patch('clio_lite_cli.clio_search_iter')
+def test_main_iter(mocked_iter, tmpdir):
+    mocked_iter.return_value = iter([{'_id': 1}, {'_id': 2}])
+    path = tmpdir.join('queries.jsonl')
+    path.write('{"id": "q", "query": "something"}\n')
+    main(['iter', '--url', 'http://example.com', '--index', 'blah',
+          '--input', str(path), '--output-dir', str(tmpdir)])
+    _, kwargs = mocked_iter.call_args
+    assert kwargs == {'url': 'http://example.com', 'index': 'blah',
+                      'query': 'something'}
+    lines = tmpdir.join('q.jsonl').read().splitlines()
+    assert [json.loads(line)['doc'] for line in lines] == [{'_id': 1},
+                                                           {'_id': 2}]
@@ -0,0 +1,117 @@
+import json
+import mock
+import pytest
+
+from clio_utils import TTLCache
+from clio_lite import SHARD_COUNTS
+from clio_lite_searchkit_lambda import AdmissionControl
+from clio_lite_searchkit_lambda import handle_event
+
+
+HITS = {'hits': {'total': {'value': 10},
+                 'hits': [{'_id': '1', '_index': 'idx', '_score': 1.0}]}}
+FACETS = {'a_facet': {'buckets': [{'key': 'x', 'doc_count': 3}]}}
+
+
+@pytest.fixture(autouse=True)
+def environ(monkeypatch):
+    monkeypatch.setenv('ALLOWED_ENDPOINTS', 'somewhere.com')
+    monkeypatch.setenv('RANGE_UPPER_LIMIT', '300')
+
+
+def make_event(offset, auth='Basic abc'):
+    query = {'query': {'simple_query_string': {'query': 'something',
+                                               'fields': ['a', 'b']}},
+             'aggregations': {'a_facet': {'terms': {'field': 'a'}}},
+             'size': 5, 'from': offset,
+             'adaptive_seeds': True, 'min_seed_score_frac': 0.8}
+    return {'body': json.dumps(query),
+            'headers': {'es-endpoint': 'somewhere.com',
+                        'Authorization': auth},
+            'pathParameters': {'proxy': 'an_index/_search'}}
+
+
+@mock.patch('clio_lite_searchkit_lambda.requests')
+@mock.patch('clio_lite_searchkit_lambda.msearch')
+@mock.patch('clio_lite_searchkit_lambda.seed_query')
+def test_facets_cached(mocked_seed_query, mocked_msearch, mocked_requests):
+    mocked_seed_query.return_value = (100, [{'_id': '1', '_index': 'idx'}])
+    mocked_msearch.side_effect = lambda *args, **kwargs: [
+        json.loads(json.dumps(HITS)), {'aggregations': FACETS}]
+    mocked_requests.post.return_value.text = json.dumps(HITS)
+    mocked_requests.post.return_value.status_code = 200
+    facet_cache = TTLCache(maxsize=10, ttl=60)
+
+    def search(offset, auth='Basic abc'):
+        response = handle_event(make_event(offset, auth),
+                                admission=AdmissionControl(),
+                                facet_cache=facet_cache)
+        assert response['statusCode'] == 200
+        return json.loads(response['body'])
+
+    # The hits page and facets are requested together...
+    data = search(0)
+    assert data['aggregations'] == FACETS
+    assert mocked_msearch.call_count == 1
+    _, kwargs = mocked_seed_query.call_args
+    assert kwargs['adaptive_seeds']
+    assert kwargs['min_seed_score_frac'] == 0.8
+    _, kwargs = mocked_msearch.call_args
+    hits_query, aggs_query = kwargs['bodies']
+    assert 'aggregations' not in hits_query
+    assert (hits_query['size'], hits_query['from']) == (5, 0)
+    assert aggs_query['aggregations'] == {'a_facet': {'terms': {'field': 'a'}}}
+
+    # ...and then the facets are served from the cache
+    data = search(5)
+    assert data['aggregations'] == FACETS
+    assert mocked_msearch.call_count == 1
+    _, kwargs = mocked_requests.post.call_args
+    hits_query = json.loads(kwargs['data'])
+    assert 'aggregations' not in hits_query
+    assert (hits_query['size'], hits_query['from']) == (5, 5)
+
+    # Other callers don't share the cached facets
+    search(5, auth='Basic def')
+    assert mocked_msearch.call_count == 2
+
+
+@mock.patch('clio_lite_searchkit_lambda.requests')
+@mock.patch('clio_lite.requests')
+def test_content_type(mocked_requests, mocked_lambda_requests):
+    for mocked in (mocked_requests, mocked_lambda_requests):
+        mocked.post.return_value.text = json.dumps(HITS)
+        mocked.post.return_value.status_code = 200
+    event = make_event(0)
+    query = json.loads(event['body'])
+    query.pop('aggregations')
+    event['body'] = json.dumps(query)
+    response = handle_event(event, admission=AdmissionControl())
+    assert response['statusCode'] == 200
+    # Both the seed and the hits requests are sent as JSON
+    for mocked in (mocked_requests, mocked_lambda_requests):
+        _, kwargs = mocked.post.call_args
+        assert kwargs['headers'] == {'Authorization': 'Basic abc',
+                                     'Content-Type': 'application/json'}
+
+
+@mock.patch('clio_lite_searchkit_lambda.msearch')
+@mock.patch('clio_lite_searchkit_lambda.seed_query')
+def test_msearch_response(mocked_seed_query, mocked_msearch, monkeypatch):
+    monkeypatch.setitem(SHARD_COUNTS, 'https://somewhere.com/an_index/_search',
+                        None)
+    mocked_seed_query.return_value = (100, [{'_id': '1', '_index': 'idx'}])
+    mocked_msearch.return_value = [dict(HITS, status=200,
+                                        _shards={'total': 3}),
+                                   {'aggregations': FACETS, 'status': 200}]
+    event = make_event(0)
+    query = json.loads(event['body'])
+    query['search_type'] = 'auto'
+    event['body'] = json.dumps(query)
+    response = handle_event(event, admission=AdmissionControl())
+    data = json.loads(response['body'])
+    # The same shape as a plain _search response
+    assert 'status' not in data
+    assert data['aggregations'] == FACETS
+    # The shard count is learned for the 'auto' search type
+    assert SHARD_COUNTS['https://somewhere.com/an_index/_search'] == 3
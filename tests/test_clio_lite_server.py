@@ -0,0 +1,245 @@
+import asyncio
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+import json
+import pytest
+import requests
+from socketserver import ThreadingMixIn
+import threading
+
+from clio_lite_server import ProxyServer
+from clio_lite_server import make_event
+from clio_lite_searchkit_lambda import AdmissionControl
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """Python 3.6 compatible version of http.server.ThreadingHTTPServer"""
+    daemon_threads = True
+
+
+class StandInES(BaseHTTPRequestHandler):
+    """Responds to every request with a single hit (out of :obj:`total`),
+    recording the requests"""
+    requests = []
+    total = 1
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        data = self.rfile.read(length)
+        hits = {'hits': {'total': {'value': StandInES.total},
+                         'hits': [{'_id': '1', '_index': 'idx',
+                                   '_score': 1.0}]}}
+        if self.path.split('?')[0].endswith('_msearch'):
+            lines = [json.loads(line) for line in data.splitlines()]
+            StandInES.requests.append((self.path, lines))
+            body = {'responses': [dict(hits, aggregations={'facet': body})
+                                  if 'aggregations' in body else hits
+                                  for body in lines[1::2]]}
+        else:
+            StandInES.requests.append((self.path, json.loads(data)))
+            body = hits
+        body = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def es_endpoint(monkeypatch):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInES)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoint = f'127.0.0.1:{server.server_address[1]}'
+    monkeypatch.setenv('ALLOWED_ENDPOINTS', f'somewhere.com;{endpoint}')
+    monkeypatch.setenv('RANGE_UPPER_LIMIT', '300')
+    StandInES.requests.clear()
+    StandInES.total = 1
+    yield endpoint
+    server.shutdown()
+
+
+@pytest.fixture
+def admission():
+    return AdmissionControl()
+
+
+async def shutdown(server):
+    """Stop listening, and cancel any open (keep-alive) connections
+    so that they're closed before the loop is"""
+    server.close()
+    await server.wait_closed()
+    # Python 3.6 compatible, i.e. asyncio.all_tasks is 3.7+
+    all_tasks = getattr(asyncio, 'all_tasks', None) or asyncio.Task.all_tasks
+    current_task = (getattr(asyncio, 'current_task', None) or
+                    asyncio.Task.current_task)
+    tasks = [task for task in all_tasks() if task is not current_task()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+@pytest.fixture
+def proxy_url(admission):
+    proxy = ProxyServer(scheme='http', workers=4, admission=admission)
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(proxy.start('127.0.0.1', 0))
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.sockets[0].getsockname()[1]}'
+    asyncio.run_coroutine_threadsafe(shutdown(server), loop).result(1)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(1)
+    loop.close()
+    proxy.close()
+
+
+def test_make_event():
+    event = make_event('/an_index/_search?x=1',
+                       {'Host': 'h', 'ES-Endpoint': 'e',
+                        'Content-Length': '2', 'Authorization': 'a'},
+                       b'{}')
+    assert event == {'body': '{}',
+                     'headers': {'es-endpoint': 'e', 'Authorization': 'a'},
+                     'pathParameters': {'proxy': 'an_index/_search'}}
+
+
+def test_passthrough(es_endpoint, proxy_url):
+    r = requests.post(f'{proxy_url}/an_index/_count', json={'a': 'b'},
+                      headers={'es-endpoint': es_endpoint})
+    assert r.status_code == 200
+    assert r.json()['hits']['total'] == 1
+    assert r.headers['Access-Control-Allow-Origin'] == '*'
+    assert StandInES.requests == [('/an_index/_count?rest_total_hits_as_int=true',
+                                   {'a': 'b'})]
+
+
+def test_expanded_search(es_endpoint, proxy_url):
+    query = {'query': {'simple_query_string': {'query': 'something',
+                                               'fields': ['a', 'b']}},
+             'post_filter': {'range': {'count': {'gte': 1, 'lte': 1000}}},
+             'size': 5}
+    with requests.Session() as session:  # Reuses the connection
+        for _ in range(2):
+            r = session.post(f'{proxy_url}/an_index/_search', json=query,
+                             headers={'es-endpoint': es_endpoint})
+            assert r.status_code == 200
+            assert r.json()['hits']['total'] == 1
+    # Seed and MLT queries, then the second response is cached
+    assert len(StandInES.requests) == 2
+    (_, seed_query), (_, mlt_query) = StandInES.requests
+    assert seed_query['query'] == query['query']
+    assert mlt_query['size'] == 5
+    assert mlt_query['post_filter'] == {'range': {'count': {'gte': 1}}}
+    assert mlt_query['query']['bool']['must'][0]['more_like_this']['like'] == [
+        {'_id': '1', '_index': 'idx'}]
+
+
+def test_facets_split_and_cached(es_endpoint, proxy_url):
+    StandInES.total = 10
+    query = {'query': {'simple_query_string': {'query': 'something',
+                                               'fields': ['a', 'b']}},
+             'aggs': {'a_facet': {'terms': {'field': 'a'}}},
+             'post_filter': {'term': {'a': 'x'}},
+             'size': 5}
+    for offset in (0, 5):  # Page through the results
+        query['from'] = offset
+        r = requests.post(f'{proxy_url}/an_index/_search', json=query,
+                          headers={'es-endpoint': es_endpoint})
+        assert r.status_code == 200
+        data = r.json()
+        assert data['hits']['total'] == 10
+        assert data['aggregations']['facet']['aggregations'] == query['aggs']
+    (_, seed_query), (path, lines), (_, seed_query_2), (_, hits_query_2) = \
+        StandInES.requests
+    # The hits and facets are requested in parallel...
+    assert path.startswith('/an_index/_msearch')
+    header, hits_query, aggs_header, aggs_query = lines
+    assert header == {'search_type': 'dfs_query_then_fetch'}
+    assert 'aggs' not in hits_query
+    assert hits_query['post_filter'] == query['post_filter']
+    assert (hits_query['size'], hits_query['from']) == (5, 0)
+    assert aggs_query['size'] == 0
+    assert aggs_query['aggregations'] == query['aggs']
+    assert 'post_filter' not in aggs_query
+    assert aggs_query['query'] == hits_query['query']
+    # ...and then only the hits page is requested for the next page
+    assert 'aggs' not in hits_query_2
+    assert (hits_query_2['size'], hits_query_2['from']) == (5, 5)
+
+
+def test_offset_past_seed_total(es_endpoint, proxy_url):
+    query = {'query': {'simple_query_string': {'query': 'something',
+                                               'fields': ['a', 'b']}},
+             'size': 5, 'from': 5}
+    r = requests.post(f'{proxy_url}/an_index/_search', json=query,
+                      headers={'es-endpoint': es_endpoint})
+    assert r.status_code == 200
+    # As for clio_search, the offset is dropped beyond the seed total
+    (_, seed_query), (_, hits_query) = StandInES.requests
+    assert hits_query['size'] == 5
+    assert 'from' not in hits_query
+
+
+def test_cache_per_caller(es_endpoint, proxy_url):
+    query = {'query': {'simple_query_string': {'query': 'something',
+                                               'fields': ['a', 'b']}}}
+    for auth in ('Basic abc', 'Basic def', 'Basic abc'):
+        r = requests.post(f'{proxy_url}/an_index/_search', json=query,
+                          headers={'es-endpoint': es_endpoint,
+                                   'Authorization': auth})
+        assert r.status_code == 200
+    # Seed and MLT queries for each caller, then a cache hit
+    assert len(StandInES.requests) == 4
+
+
+def test_unregistered_endpoint(es_endpoint, proxy_url):
+    r = requests.post(f'{proxy_url}/an_index/_search', json={},
+                      headers={'es-endpoint': 'elsewhere.com'})
+    assert r.status_code == 403
+    r = requests.post(f'{proxy_url}/an_index/_search', json={})
+    assert r.status_code == 400
+
+
+def test_admission_control():
+    admission = AdmissionControl(rate=1, burst=2, max_inflight=1)
+    assert admission.admit('a')
+    assert not admission.admit('a')  # Too many in flight
+    assert admission.admit('b')  # Limits are per endpoint
+    admission.release('a')
+    assert admission.admit('a')
+    admission.release('a')
+    assert not admission.admit('a')  # Rate limited
+    assert admission.admit_degraded('a')  # Degraded queries are unlimited
+    admission = AdmissionControl(rate=0, burst=1)
+    assert admission.admit('a')
+    assert not admission.admit('a')  # Never refilled
+
+
+@pytest.mark.parametrize('admission', [AdmissionControl(max_inflight=0,
+                                                        degraded_rate=0,
+                                                        degraded_burst=1)])
+def test_degraded_and_shed(es_endpoint, proxy_url):
+    query = {'query': {'simple_query_string': {'query': 'something',
+                                               'fields': ['a', 'b']}},
+             'size': 5, 'min_doc_frac': 0.1}
+    r = requests.post(f'{proxy_url}/an_index/_search', json=query,
+                      headers={'es-endpoint': es_endpoint})
+    assert r.status_code == 200
+    # Served a plain query, without the clio-lite parameters
+    assert StandInES.requests == [('/an_index/_search?rest_total_hits_as_int=true',
+                                   {'query': query['query'], 'size': 5})]
+    query['size'] = 10  # Not cached
+    r = requests.post(f'{proxy_url}/an_index/_search', json=query,
+                      headers={'es-endpoint': es_endpoint})
+    assert r.status_code == 429
+    r = requests.get(f'{proxy_url}/_clio/metrics')
+    assert r.json() == {es_endpoint: {'degraded': 1, 'shed': 1}}
+
+
+def test_malformed_body(es_endpoint, proxy_url):
+    r = requests.post(f'{proxy_url}/an_index/_search', data='not json',
+                      headers={'es-endpoint': es_endpoint})
+    assert r.status_code == 400
@@ -0,0 +1,84 @@
+import mock
+import pytest
+
+from clio_standing import StandingQueries
+
+
+@pytest.fixture
+def standing(tmpdir):
+    standing = StandingQueries(str(tmpdir.join('standing.json')),
+                               url='http://www.example.com', index='blah',
+                               watermark_field='date', max_seed_age=100)
+    standing.add('a_query', query='something', fields=['a', 'b'],
+                 post_filters=[{'a_post_filter': None}],
+                 min_should_match=0.5)
+    return standing
+
+
+@mock.patch('clio_standing.max_value', return_value=1000)
+@mock.patch('clio_standing.simple_query')
+@mock.patch('clio_standing.more_like_this')
+def test_first_run(mocked_mlt, mocked_simple_query, mocked_max_value,
+                   standing):
+    assert standing.run('a_query') == (0, [])
+    assert mocked_simple_query.call_count == 0
+    assert mocked_mlt.call_count == 0
+    assert standing.queries['a_query']['watermark'] == 1000
+
+
+@mock.patch('clio_standing.time.time')
+@mock.patch('clio_standing.max_value')
+@mock.patch('clio_standing.simple_query', return_value=(23, ['x', 'y']))
+@mock.patch('clio_standing.more_like_this', return_value=(None, [1, 2]))
+def test_run(mocked_mlt, mocked_simple_query, mocked_max_value,
+             mocked_time, standing):
+    standing.queries['a_query']['watermark'] = 1000
+    mocked_max_value.side_effect = [2000, 3000, 4000]
+    mocked_time.side_effect = [0, 50, 150, 150]
+
+    # The seed is computed on the first run, and then reused until stale
+    for _ in range(3):
+        total, docs = standing.run('a_query')
+        assert (total, docs) == (2, [1, 2])
+    assert mocked_simple_query.call_count == 2
+    assert mocked_mlt.call_count == 3
+    _, kwargs = mocked_mlt.call_args
+    assert kwargs['docs'] == ['x', 'y']
+    assert kwargs['total'] == 23
+    assert kwargs['min_should_match'] == 0.5
+    assert kwargs['filters'] == [{'a_post_filter': None},
+                                 {'range': {'date': {'gt': 3000,
+                                                     'lte': 4000}}}]
+
+    # The state is persisted
+    reloaded = StandingQueries(standing.path, url='http://www.example.com',
+                               index='blah', watermark_field='date')
+    assert reloaded.queries['a_query']['watermark'] == 4000
+    assert reloaded.queries['a_query']['seed']['docs'] == ['x', 'y']
+
+
+@mock.patch('clio_standing.max_value', return_value=1000)
+@mock.patch('clio_standing.more_like_this')
+def test_run_nothing_new(mocked_mlt, mocked_max_value, standing):
+    standing.queries['a_query']['watermark'] = 1000
+    standing.queries['a_query']['seed'] = dict(total=1, docs=[],
+                                               created=10**12)
+    assert standing.run_all() == {'a_query': (0, [])}
+    assert mocked_mlt.call_count == 0
+
+
+@mock.patch('clio_standing.max_value', return_value=1767225600000.0)
+@mock.patch('clio_standing.simple_query', return_value=(23, ['x', 'y']))
+@mock.patch('clio_standing.more_like_this', return_value=(None, []))
+def test_run_date_watermark(mocked_mlt, mocked_simple_query,
+                            mocked_max_value, tmpdir):
+    standing = StandingQueries(str(tmpdir.join('standing.json')),
+                               url='http://www.example.com', index='blah',
+                               watermark_field='date', lag=60000)
+    standing.add('a_query', query='something', watermark='2026-01-01')
+    standing.run('a_query')
+    # Compared by ES, and held back by the lag
+    _, kwargs = mocked_mlt.call_args
+    assert kwargs['filters'] == [{'range': {'date': {
+        'gt': '2026-01-01', 'lte': 1767225540000.0}}}]
+    assert standing.queries['a_query']['watermark'] == 1767225540000.0